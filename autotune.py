@@ -0,0 +1,173 @@
+"""
+Throughput autotuning of the collection and update settings.
+Runs short timed training trials of the agent of options.algo over a grid
+of settings (number of workers, rollout length or batch size, learner
+threads), each in a fresh process pinned by the placement manager, and
+measures environment steps and learner updates per second. Trials over
+options.memory_budget are discarded. The best settings are written as a
+JSON options file, which main.py loads with --config.
+"""
+
+import os
+import json
+import math
+import random
+import shutil
+import argparse
+import itertools
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+TRIALS_FILE = 'autotune_trials.json'
+
+# Settings searched for each algorithm
+SEARCH_SPACE = {
+    'dqn': {
+        'batch_size': [16, 32, 64, 128]
+    },
+    'a2c': {
+        'n_workers': [4, 8, 16, 32],
+        'buffer_update_freq': [5, 10, 20, 50]
+    }
+}
+SEARCH_SPACE['ppo'] = SEARCH_SPACE['a2c']
+
+
+
+def learner_thread_candidates(options):
+    """
+    Learner thread counts worth trying on this machine: powers of two up
+    to the physical cores left next to the environments.
+
+    Returns:
+        list: learner_threads values (0 lets the placement manager decide)
+    """
+    from placement import cpu_topology, plan_process
+
+    if options.placement == 'none':
+        return [0]
+    n_cores = len(plan_process(cpu_topology())['learner'])
+    candidates = [n for n in (1, 2, 4, 8, 16, 32, 64) if n < n_cores] + [n_cores]
+    return candidates if n_cores else [0]
+
+
+def trial_settings(options):
+    """
+    List the settings to try, a seeded random subset of the grid if it has
+    more than options.autotune_max_trials points.
+
+    Returns:
+        list: dicts of option overrides
+    """
+    space = dict(SEARCH_SPACE[options.algo])
+    space['learner_threads'] = learner_thread_candidates(options)
+    grid = [dict(zip(space, values)) for values in itertools.product(*space.values())]
+    if len(grid) > options.autotune_max_trials:
+        grid = random.Random(options.seed).sample(grid, options.autotune_max_trials)
+    return grid
+
+
+def run_trial(options, settings):
+    """
+    Train for about options.autotune_iterations iterations (rounded up to
+    whole update cycles) with the given settings and measure the
+    throughput. Runs in a fresh pool process.
+
+    Arguments:
+        options (dict): run options
+        settings (dict): option overrides of this trial
+
+    Returns:
+        dict: settings, throughput, peak memory and whether the trial fit the memory budget
+    """
+    import time
+    from main import make_agent
+    from placement import place_process
+    from memory_telemetry import process_rss, MB
+
+    options = argparse.Namespace(**options)
+    options.mode = 'train'
+    options.weights_dir = ''
+    options.exp_name = tempfile.mkdtemp(prefix='drl-autotune-')
+    options.n_seeds = 1
+    options.start_iteration = 1
+    options.record_trajectories = options.offline_data = options.save_replay = options.load_replay = ''
+    for name, value in settings.items():
+        setattr(options, name, value)
+
+    # Whole update cycles: at least two rollouts, or two batches in replay memory
+    cycle = options.batch_size if options.algo == 'dqn' else options.buffer_update_freq
+    n_iterations = max(options.autotune_iterations, 2 * cycle)
+    if options.algo != 'dqn':
+        n_iterations = cycle * math.ceil(n_iterations / cycle)
+    options.n_train_iterations = n_iterations + 1
+    options.save_frequency = options.log_frequency = options.n_train_iterations
+    options.memory_report_frequency = max(1, n_iterations // 10)
+
+    place_process(options)
+    agent = make_agent(options)
+    result = {'settings': settings, 'feasible': True}
+    start = time.perf_counter()
+    try:
+        agent.train()
+    except MemoryError as error:
+        agent.metrics.close()
+        result.update({'feasible': False, 'error': str(error).splitlines()[0]})
+    elapsed = time.perf_counter() - start
+
+    n_steps = n_iterations * (1 if options.algo == 'dqn' else options.n_workers)
+    samples_per_update = options.batch_size if options.algo == 'dqn' else options.n_workers * options.buffer_update_freq
+    updates_per_second = agent.timer.n_updates / elapsed
+    result.update({
+        'env_steps_per_second': n_steps / elapsed,
+        'updates_per_second': updates_per_second,
+        'samples_per_second': updates_per_second * samples_per_update,
+        'rss_mb': process_rss() / MB
+    })
+    shutil.rmtree(options.exp_name, ignore_errors=True)
+    return result
+
+
+def autotune(options):
+    """
+    Run every trial, print the ranking and write the best settings to
+    options.autotune_output.
+
+    Arguments:
+        options (argparse.Namespace): run options
+
+    Returns:
+        dict: best settings, None if no trial fit the memory budget
+    """
+    grid = trial_settings(options)
+    print(f"Autotuning {options.algo}: {len(grid)} trials of {options.autotune_iterations} iterations")
+
+    # One process per trial, so memory and thread settings do not carry over
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for k, settings in enumerate(grid):
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            result = pool.submit(run_trial, vars(options), settings).result()
+        results.append(result)
+        status = '' if result['feasible'] else f"  over budget: {result['error']}"
+        print(f"[{k + 1}/{len(grid)}] {settings}: {result['env_steps_per_second']:.1f} steps/s, "
+              f"{result['updates_per_second']:.2f} updates/s, {result['rss_mb']:.0f} MB{status}")
+
+    if not os.path.exists(options.exp_name):
+        os.makedirs(options.exp_name)
+    with open(os.path.join(options.exp_name, TRIALS_FILE), 'w') as f:
+        json.dump(results, f, indent=2)
+
+    feasible = [r for r in results if r['feasible']]
+    if not feasible:
+        print(f"No setting fits the memory budget of {options.memory_budget} MB")
+        return None
+
+    best = max(feasible, key=lambda r: r[options.autotune_objective])
+    config = dict(algo=options.algo, **best['settings'])
+    with open(options.autotune_output, 'w') as f:
+        json.dump(config, f, indent=2)
+    print(f"Best {options.autotune_objective}: {best[options.autotune_objective]:.2f} with {best['settings']}")
+    print(f"Wrote {options.autotune_output}, use it with: python main.py --config={options.autotune_output}")
+    return config
@@ -0,0 +1,707 @@
+"""
+Reproducible micro/macro benchmarks of the agents.
+Runs offline against a deterministic stub of game.wrapper.Game, so the
+numbers measure the agents themselves and not the flappy bird renderer.
+
+Usage:
+    # Run the suite and store the results
+    python benchmark.py --output baseline.json
+
+    # Run again later and flag anything that got slower than the baseline
+    python benchmark.py --output current.json --baseline baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import numpy as np
+
+import torch
+
+BENCHMARK_VERSION = 1
+
+
+
+class StubGame():
+
+    # Number of distinct background frames each stub game cycles through
+    N_FRAMES = 64
+
+    # A pipe every PIPE_INTERVAL frames, an episode ends after MAX_PIPES pipes
+    PIPE_INTERVAL = 8
+    MAX_PIPES = 50
+
+    # Games are numbered in construction order since seed_everything(), and
+    # each one is seeded from the benchmark seed and its number
+    base_seed = 0
+    instances = 0
+    lock = threading.Lock()
+
+    def __init__(self, frame_size, seed=0):
+        """
+        Initialize a deterministic stand-in for game.wrapper.Game. Frames are
+        binary images drawn from a fixed seed. Pipes come on a fixed schedule
+        and each needs a seeded random action (flap or not), which a band
+        at the top of the frames shows ahead of time: passing a pipe gives a
+        reward of 1, the wrong action ends the episode. Scores therefore
+        depend on the policy, like in the real game.
+        """
+        with StubGame.lock:
+            index = StubGame.instances
+            StubGame.instances += 1
+        self.frame_size = int(frame_size)
+        self.rng = random.Random(StubGame.base_seed + seed + index)
+
+        generator = torch.Generator().manual_seed(seed)
+        self.frames = (torch.rand(self.N_FRAMES, 1, self.frame_size, self.frame_size, generator=generator) > 0.5).float()
+        self.band = max(1, self.frame_size // 8)
+        self.t = 0
+        self.n_pipes = 0
+        self.gap = self.rng.randint(0, 1)
+
+
+    @classmethod
+    def reset(cls, seed):
+        """
+        Restart the game numbering, so the games built next get the same
+        seeds regardless of what ran before in the process.
+        """
+        with cls.lock:
+            cls.base_seed = seed
+            cls.instances = 0
+
+
+    def render(self):
+        """
+        Returns:
+            tensor: current frame of size (1, frame_size, frame_size), its top
+            band filled with the action the next pipe needs
+        """
+        frame = self.frames[self.t % self.N_FRAMES].clone()
+        frame[:, :self.band] = float(self.gap)
+        return frame
+
+
+    def step(self, action):
+        """
+        Advance the game by one frame.
+
+        Arguments:
+            action (int): 0 to do nothing, 1 to flap
+
+        Returns:
+            tensor: next frame of size (1, frame_size, frame_size)
+            float: reward
+            bool: True if the episode ended
+        """
+        self.t += 1
+        if self.t % self.PIPE_INTERVAL:
+            return self.render(), 0.1, False
+
+        # At a pipe: the wrong action crashes, the right one passes it
+        passed = int(action) == self.gap
+        self.gap = self.rng.randint(0, 1)
+        if not passed:
+            self.t, self.n_pipes = 0, 0
+            return self.render(), -1.0, True
+        self.n_pipes += 1
+        if self.n_pipes >= self.MAX_PIPES:
+            self.t, self.n_pipes = 0, 0
+            return self.render(), 1.0, True
+        return self.render(), 1.0, False
+
+
+
+def install_stub_game():
+    """
+    Register StubGame as game.wrapper.Game. Must be called before the agent
+    modules are imported.
+    """
+    game = types.ModuleType('game')
+    wrapper = types.ModuleType('game.wrapper')
+    wrapper.Game = StubGame
+    game.wrapper = wrapper
+    sys.modules['game'] = game
+    sys.modules['game.wrapper'] = wrapper
+
+
+def seed_everything(seed):
+    """
+    Seed every random number generator the agents use, and restart the
+    seeding of stub games.
+
+    Arguments:
+        seed (int): random seed
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    StubGame.reset(seed)
+
+
+def make_options(**overrides):
+    """
+    Build agent options from the main.py defaults.
+
+    Arguments:
+        overrides: option values to override
+
+    Returns:
+        argparse.Namespace: agent options
+    """
+    from main import parser
+    options = parser.parse_args([])
+    options.metrics_flush_interval = 3600.0
+    # Serial game construction, so every stub game gets the same seed on every run
+    options.game_init_threads = 1
+    for key, value in overrides.items():
+        setattr(options, key, value)
+    return options
+
+
+def measure(fn, number=10, repeat=5, warmup=1):
+    """
+    Time a function.
+
+    Arguments:
+        fn (function): function to time, called without arguments
+        number (int): calls per timed repeat
+        repeat (int): number of timed repeats
+        warmup (int): untimed calls before timing
+
+    Returns:
+        dict: median/min/mean seconds per call and calls per second
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    median = float(np.median(times))
+    return {
+        'median_s': median,
+        'min_s': float(np.min(times)),
+        'mean_s': float(np.mean(times)),
+        'per_second': 1.0 / median if median > 0 else float('inf')
+    }
+
+
+def close_agent(agent):
+    """
+    Stop the background metrics thread of an agent if it has one.
+    """
+    if hasattr(agent, 'metrics'):
+        agent.metrics.close()
+
+
+
+def probe_states(args, frame_size, n_states=256):
+    """
+    Stacked states of a stub game played with seeded random actions, to
+    compare policies on identical inputs.
+
+    Arguments:
+        args (argparse.Namespace): benchmark arguments, for the seed
+        frame_size (int): size of the frames
+        n_states (int): number of states
+
+    Returns:
+        tensor: states of size (n_states, len_agent_history, frame_size, frame_size)
+        tensor: action the next pipe needs in each state, shown by its cue band
+    """
+    seed_everything(args.seed)
+    history = make_options().len_agent_history
+    game = StubGame(frame_size)
+    frames = [game.render()] * history
+    states = []
+    for _ in range(n_states):
+        frame, _, _ = game.step(random.randint(0, 1))
+        frames = frames[1:] + [frame]
+        states.append(torch.cat(frames))
+    states = torch.stack(states)
+    return states, states[:, -1, 0, 0].long()
+
+
+def policy_outputs(agent, states):
+    """
+    Returns:
+        tensor: float32 Q-values (DQN) or action log probabilities (A2C/PPO)
+        of the agent's network for each state
+    """
+    with torch.no_grad():
+        outputs = agent.net(states.to(next(agent.net.parameters()).device))
+    if isinstance(outputs, tuple):
+        outputs = torch.log_softmax(outputs[1].float(), dim=1)
+    return outputs.float().cpu()
+
+
+def cue_metrics(outputs, cues):
+    """
+    How well a policy follows the stub game's pipe cue on probe states.
+
+    Arguments:
+        outputs (tensor): policy_outputs() of the probe states
+        cues (tensor): action the next pipe needs in each probe state
+
+    Returns:
+        dict: share of states whose greedy action is the cued one, and mean
+        margin of the cued action's output over the other one's
+    """
+    cued = outputs.gather(1, cues.view(-1, 1)).view(-1)
+    other = outputs.gather(1, (1 - cues).view(-1, 1)).view(-1)
+    return {
+        'cue_accuracy': float((outputs.argmax(1) == cues).float().mean()),
+        'cue_margin': float((cued - other).mean())
+    }
+
+
+
+# ---------------------------------------------------------------------------
+# Micro benchmarks
+# ---------------------------------------------------------------------------
+
+def bench_replay_memory(args, log_dir):
+    """
+    ReplayMemory.add at full capacity and ReplayMemory.sample.
+    All experiences share one state tensor so large capacities fit in RAM.
+    """
+    from dqn import ReplayMemory, Experience
+
+    results = {}
+    state = torch.zeros(4, args.frame_size, args.frame_size)
+    experience = Experience(state, 0, 0.1, state, False)
+    for capacity in args.capacities:
+        memory = ReplayMemory(make_options(replay_memory_size=capacity))
+        for _ in range(capacity):
+            memory.add(experience)
+
+        results[f'replay_add/capacity={capacity}'] = measure(
+            lambda: memory.add(experience), number=100, repeat=args.repeat)
+        results[f'replay_sample/capacity={capacity}'] = measure(
+            lambda: memory.sample(32), number=10, repeat=args.repeat)
+    return results
+
+
+def bench_dqn_optimize(args, log_dir):
+    """
+    DQNAgent.optimize_model on a replay memory filled by the stub game.
+    """
+    from dqn import DQNAgent, Experience
+
+    options = make_options(exp_name=log_dir, frame_size=args.frame_size)
+    agent = DQNAgent(options)
+    frame, _, _ = agent.game.step(0)
+    state = torch.cat([frame for _ in range(options.len_agent_history)])
+    for i in range(options.batch_size * 4):
+        frame, reward, done = agent.game.step(i % 2)
+        next_state = torch.cat([state[1:], frame])
+        agent.replay_memory.add(Experience(state, i % 2, reward, next_state, done))
+        state = next_state
+
+    return {'dqn/optimize_model': measure(agent.optimize_model, number=5, repeat=args.repeat)}
+
+
+def fill_rollout(agent):
+    """
+    Collect one rollout (buffer_update_freq steps of every worker) into the
+    memory of an A2C/PPO agent.
+    """
+    from a2c import Experience
+
+    agent.memory = []
+    states, _, _ = agent.env_step(None, np.zeros(agent.opt.n_workers))
+    for _ in range(agent.opt.buffer_update_freq):
+        values, actions, action_log_probs = agent.net.act(states)
+        next_states, rewards, dones = agent.env_step(states, actions)
+        masks = torch.FloatTensor([[0.0] if done else [1.0] for done in dones])
+        agent.memory.append(
+            Experience(states.data, actions.data, action_log_probs.data, values.data, rewards, masks)
+        )
+        states = next_states
+
+
+def bench_actor_critic_optimize(args, log_dir):
+    """
+    A2CAgent/PPOAgent.optimize_model over n_workers x buffer_update_freq.
+    """
+    from a2c import A2CAgent
+    from ppo import PPOAgent
+
+    results = {}
+    for name, agent_class in (('a2c', A2CAgent), ('ppo', PPOAgent)):
+        for n_workers in args.n_workers:
+            for buffer_update_freq in args.buffer_update_freqs:
+                options = make_options(
+                    algo=name, exp_name=log_dir, frame_size=args.frame_size,
+                    n_workers=n_workers, buffer_update_freq=buffer_update_freq
+                )
+                agent = agent_class(options)
+                fill_rollout(agent)
+                key = f'{name}/optimize_model/n_workers={n_workers},buffer_update_freq={buffer_update_freq}'
+                results[key] = measure(agent.optimize_model, number=2, repeat=args.repeat)
+                close_agent(agent)
+    return results
+
+
+def bench_env_step(args, log_dir):
+    """
+    A2CAgent.env_step scaling with the number of workers.
+    """
+    from a2c import A2CAgent
+
+    results = {}
+    for n_workers in args.n_workers:
+        options = make_options(algo='a2c', exp_name=log_dir, frame_size=args.frame_size, n_workers=n_workers)
+        agent = A2CAgent(options)
+        states, _, _ = agent.env_step(None, np.zeros(n_workers))
+        actions = torch.zeros(n_workers, 1, dtype=torch.long)
+        results[f'env_step/n_workers={n_workers}'] = measure(
+            lambda: agent.env_step(states, actions), number=20, repeat=args.repeat)
+        close_agent(agent)
+    return results
+
+
+
+# ---------------------------------------------------------------------------
+# Macro benchmarks
+# ---------------------------------------------------------------------------
+
+def bench_end_to_end(args, log_dir):
+    """
+    Environment steps per second of the full training loop of each agent.
+    """
+    from dqn import DQNAgent
+    from a2c import A2CAgent
+    from ppo import PPOAgent
+
+    results = {}
+    for name, agent_class in (('dqn', DQNAgent), ('a2c', A2CAgent), ('ppo', PPOAgent)):
+        options = make_options(
+            algo=name, exp_name=os.path.join(log_dir, name), frame_size=args.frame_size,
+            n_train_iterations=args.train_iterations + 1
+        )
+        seed_everything(args.seed)
+        agent = agent_class(options)
+        start = time.perf_counter()
+        agent.train()
+        elapsed = time.perf_counter() - start
+
+        steps = args.train_iterations * (1 if name == 'dqn' else options.n_workers)
+        results[f'end_to_end/{name}'] = {
+            'median_s': elapsed / args.train_iterations,
+            'min_s': elapsed / args.train_iterations,
+            'mean_s': elapsed / args.train_iterations,
+            'per_second': args.train_iterations / elapsed,
+            'env_steps_per_second': steps / elapsed
+        }
+    return results
+
+
+def bench_mixed_precision(args, log_dir):
+    """
+    Learner updates per second and final greedy score of each agent trained
+    from the same seed in float32 and in bfloat16 mixed precision. Short
+    runs rarely pass a pipe, so each bfloat16 policy is also compared with
+    the float32 one on the same probe states: how often their greedy
+    actions agree, and the mean absolute difference of their outputs,
+    along with how closely each follows the pipe cue (cue_metrics).
+    Absolute scores need the real Game.
+    """
+    from dqn import DQNAgent
+    from a2c import A2CAgent
+    from ppo import PPOAgent
+
+    states, cues = probe_states(args, args.frame_size)
+    results = {}
+    for name, agent_class in (('dqn', DQNAgent), ('a2c', A2CAgent), ('ppo', PPOAgent)):
+        reference = None
+        for precision, mixed_precision in (('fp32', 0), ('bf16', 1)):
+            options = make_options(
+                algo=name, exp_name=os.path.join(log_dir, f'{name}_{precision}'), frame_size=args.frame_size,
+                n_train_iterations=args.train_iterations + 1, mixed_precision=mixed_precision,
+                eval_episodes=args.eval_episodes
+            )
+            seed_everything(args.seed)
+            agent = agent_class(options)
+            agent.train()
+
+            if name != 'dqn':
+                fill_rollout(agent)
+            updates = measure(agent.optimize_model, number=2, repeat=args.repeat)
+
+            seed_everything(args.seed)
+            episodes = agent.play_game()
+            outputs = policy_outputs(agent, states)
+            if reference is None:
+                reference = outputs
+            updates.update({
+                'score_mean': episodes['score']['mean'],
+                'return_mean': episodes['return']['mean'],
+                'action_agreement': float((outputs.argmax(1) == reference.argmax(1)).float().mean()),
+                'output_delta': float((outputs - reference).abs().mean())
+            })
+            updates.update(cue_metrics(outputs, cues))
+            results[f'mixed_precision/{name}/{precision}'] = updates
+    return results
+
+
+def bench_resolution(args, log_dir):
+    """
+    Environment steps per second, final greedy score and buffer memory of
+    each agent trained from the same seed at every frame size. The stub
+    game shows its pipe cue at every resolution, so the scores compare
+    how well each resolution learns it. Short runs rarely pass a pipe, so
+    how closely each policy follows the cue on probe states is reported
+    too (cue_metrics). Absolute scores need the real Game.
+    """
+    from dqn import DQNAgent
+    from a2c import A2CAgent
+    from ppo import PPOAgent
+
+    results = {}
+    for name, agent_class in (('dqn', DQNAgent), ('a2c', A2CAgent), ('ppo', PPOAgent)):
+        for frame_size in args.frame_sizes:
+            states, cues = probe_states(args, frame_size)
+            options = make_options(
+                algo=name, exp_name=os.path.join(log_dir, f'{name}_{frame_size}'), frame_size=frame_size,
+                n_train_iterations=args.train_iterations + 1, eval_episodes=args.eval_episodes
+            )
+            seed_everything(args.seed)
+            agent = agent_class(options)
+            start = time.perf_counter()
+            agent.train()
+            elapsed = time.perf_counter() - start
+
+            seed_everything(args.seed)
+            episodes = agent.play_game()
+            cues_followed = cue_metrics(policy_outputs(agent, states), cues)
+            usage = agent.memory_usage()
+            steps = args.train_iterations * (1 if name == 'dqn' else options.n_workers)
+            results[f'resolution/{name}/frame_size={frame_size}'] = {
+                'median_s': elapsed / args.train_iterations,
+                'min_s': elapsed / args.train_iterations,
+                'mean_s': elapsed / args.train_iterations,
+                'per_second': args.train_iterations / elapsed,
+                'env_steps_per_second': steps / elapsed,
+                'score_mean': episodes['score']['mean'],
+                'return_mean': episodes['return']['mean'],
+                'episode_length_mean': episodes['episode_length']['mean'],
+                **cues_followed,
+                'state_bytes': 4 * options.len_agent_history * frame_size ** 2,
+                'buffer_mb': sum(n for key, n in usage.items() if key != 'network') / (1 << 20),
+                'network_mb': usage['network'] / (1 << 20)
+            }
+    return results
+
+
+def bench_memory_budget(args, log_dir):
+    """
+    Train each agent under a tight memory budget, sized with
+    fit_to_budget() on top of what the process holds once the agent is
+    built, and check that the process stays within it.
+    """
+    from dqn import DQNAgent
+    from a2c import A2CAgent
+    from ppo import PPOAgent
+    from memory_telemetry import MemoryMonitor, fit_to_budget, process_rss, MB
+
+    results = {}
+    for name, agent_class in (('dqn', DQNAgent), ('a2c', A2CAgent), ('ppo', PPOAgent)):
+        options = make_options(
+            algo=name, exp_name=os.path.join(log_dir, f'{name}_budget'), frame_size=args.frame_size,
+            n_train_iterations=args.train_iterations + 1,
+            memory_report_frequency=max(1, args.train_iterations // 10)
+        )
+        seed_everything(args.seed)
+        agent = agent_class(options)
+
+        # Room for only part of the default buffers
+        options.memory_budget = int(process_rss() / MB) + args.budget_slack
+        agent.memory_monitor = MemoryMonitor(options)
+        fit_to_budget(agent)
+
+        within_budget = True
+        start = time.perf_counter()
+        try:
+            agent.train()
+        except MemoryError as error:
+            print(error)
+            agent.metrics.close()
+            within_budget = False
+        elapsed = time.perf_counter() - start
+        rss = process_rss()
+
+        results[f'memory_budget/{name}'] = {
+            'median_s': elapsed / args.train_iterations,
+            'min_s': elapsed / args.train_iterations,
+            'mean_s': elapsed / args.train_iterations,
+            'per_second': args.train_iterations / elapsed,
+            'memory_budget_mb': options.memory_budget,
+            'rss_mb': rss / MB,
+            'replay_memory_size': options.replay_memory_size,
+            'buffer_update_freq': options.buffer_update_freq,
+            'within_budget': within_budget and rss <= options.memory_budget * MB
+        }
+    return results
+
+
+SUITES = {
+    'micro': [bench_replay_memory, bench_dqn_optimize, bench_actor_critic_optimize, bench_env_step],
+    'macro': [bench_end_to_end, bench_mixed_precision, bench_resolution, bench_memory_budget]
+}
+
+
+
+# ---------------------------------------------------------------------------
+# Reporting
+# ---------------------------------------------------------------------------
+
+def metadata(args):
+    """
+    Returns:
+        dict: description of the machine and code the benchmarks ran on
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'benchmark_version': BENCHMARK_VERSION,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'torch': torch.__version__,
+        'torch_threads': torch.get_num_threads(),
+        'numpy': np.__version__,
+        'cuda': torch.cuda.is_available(),
+        'seed': args.seed,
+        'suite': args.suite,
+        'quick': args.quick
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare benchmark results against a baseline.
+
+    Arguments:
+        results (dict): benchmark results
+        baseline (dict): baseline results
+        threshold (float): relative slowdown which counts as a regression
+
+    Returns:
+        list: (name, baseline seconds, current seconds, relative change) of regressions
+    """
+    regressions = []
+    print(f"{'benchmark':<70} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        old = baseline['results'][name]['median_s']
+        new = result['median_s']
+        change = (new - old) / old if old > 0 else 0.0
+        flag = '  SLOWER' if change > threshold else ''
+        print(f"{name:<70} {old * 1e3:>10.3f}ms {new * 1e3:>10.3f}ms {change:>+7.1%}{flag}")
+        if change > threshold:
+            regressions.append((name, old, new, change))
+    return regressions
+
+
+parser = argparse.ArgumentParser(description="drl-experiment benchmarks")
+parser.add_argument("--suite",
+                    type=str,
+                    help="which benchmarks to run",
+                    default="all",
+                    choices=["micro", "macro", "all"])
+parser.add_argument("--output",
+                    type=str,
+                    help="file to write the JSON results to",
+                    default="")
+parser.add_argument("--baseline",
+                    type=str,
+                    help="JSON results to compare against",
+                    default="")
+parser.add_argument("--threshold",
+                    type=float,
+                    help="relative slowdown against the baseline which is flagged as a regression",
+                    default=0.1)
+parser.add_argument("--quick",
+                    action="store_true",
+                    help="run a reduced parameter grid")
+parser.add_argument("--seed",
+                    type=int,
+                    help="random seed",
+                    default=0)
+parser.add_argument("--repeat",
+                    type=int,
+                    help="number of timed repeats per benchmark",
+                    default=5)
+parser.add_argument("--frame_size",
+                    type=int,
+                    help="size of stub game frames in pixels",
+                    default=84)
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.capacities = [1000, 10000] if args.quick else [1000, 10000, 100000]
+    args.n_workers = [1, 8] if args.quick else [1, 4, 8, 16]
+    args.buffer_update_freqs = [5, 20] if args.quick else [5, 20, 50]
+    args.train_iterations = 50 if args.quick else 500
+    args.eval_episodes = 5 if args.quick else 20
+    args.frame_sizes = [42, 84] if args.quick else [42, 64, 84]
+    args.budget_slack = 150
+
+    install_stub_game()
+    seed_everything(args.seed)
+
+    suites = ['micro', 'macro'] if args.suite == 'all' else [args.suite]
+    log_dir = tempfile.mkdtemp(prefix='drl-benchmark-')
+    results = {'metadata': metadata(args), 'results': {}}
+    try:
+        for suite in suites:
+            for bench in SUITES[suite]:
+                print(f"Running {bench.__name__}...")
+                seed_everything(args.seed)
+                results['results'].update(bench(args, log_dir))
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    over_budget = [name for name, result in results['results'].items() if result.get('within_budget') is False]
+    if over_budget:
+        print(f"Over the memory budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) slower than the baseline by more than {args.threshold:.0%}")
+            sys.exit(1)
@@ -0,0 +1,69 @@
+"""
+Conv stacks of the agents' networks. Each network has the stack of its
+paper and a finer-strided one for low-resolution frames; conv_stack()
+picks one from options.frame_size unless --conv_stack names it.
+"""
+
+import torch
+
+# Conv layers as (out_channels, kernel_size, stride) for each network
+CONV_STACKS = {
+    'dqn': {
+        'standard': ((32, 8, 4), (64, 4, 2), (64, 3, 1)),
+        'small': ((32, 4, 2), (64, 3, 2), (64, 3, 1))
+    },
+    'actor_critic': {
+        'standard': ((16, 8, 4), (32, 4, 2)),
+        'small': ((16, 4, 2), (32, 3, 2))
+    }
+}
+
+# Frames smaller than this use the small conv stack when conv_stack is auto
+SMALL_FRAME_SIZE = 64
+
+
+
+def conv_stack(options):
+    """
+    Returns:
+        str: name of the conv stack used for options.frame_size
+    """
+    if options.conv_stack != 'auto':
+        return options.conv_stack
+    return 'small' if options.frame_size < SMALL_FRAME_SIZE else 'standard'
+
+
+
+def conv_layers(options, network):
+    """
+    Arguments:
+        options (dict): training options
+        network (str): key of the network in CONV_STACKS
+
+    Returns:
+        tuple: (out_channels, kernel_size, stride) of each conv layer
+    """
+    return CONV_STACKS[network][conv_stack(options)]
+
+
+
+def conv_output_size(options, convs):
+    """
+    Run a blank state through a conv stack to size the first fully
+    connected layer.
+
+    Arguments:
+        options (dict): training options
+        convs (list): conv layers in forward order
+
+    Returns:
+        int: number of features of one state after the conv stack
+    """
+    x = torch.zeros(1, options.len_agent_history, options.frame_size, options.frame_size)
+    try:
+        with torch.no_grad():
+            for conv in convs:
+                x = conv(x)
+    except RuntimeError:
+        raise ValueError(f"frame_size {options.frame_size} is too small for the {conv_stack(options)} conv stack")
+    return x.numel()
@@ -12,15 +12,20 @@ import numpy as np
 from collections import namedtuple
 
 import torch
-from tensorboardX import SummaryWriter
 
 from game.wrapper import Game
+from metrics import MetricsLogger
+from profiling import PhaseTimer
+from evaluate import evaluate
+from memory_telemetry import MemoryMonitor, tensor_bytes, module_bytes
+from replay_snapshot import save_replay_snapshot, read_snapshot_index, iter_replay_snapshot
+from trajectories import make_recorder, offline_batches
+from conv_stacks import conv_layers, conv_output_size
 
 # Global parameter which tells us if we have detected a CUDA capable device
 CUDA_DEVICE = torch.cuda.is_available()
 
 
-
 class DQN(torch.nn.Module):
 
     def __init__(self, options):
@@ -32,13 +37,14 @@ class DQN(torch.nn.Module):
 
         self.opt = options
         
-        self.conv1 = torch.nn.Conv2d(self.opt.len_agent_history, 32, 8, 4)
+        (c1, k1, s1), (c2, k2, s2), (c3, k3, s3) = conv_layers(self.opt, 'dqn')
+        self.conv1 = torch.nn.Conv2d(self.opt.len_agent_history, c1, k1, s1)
         self.relu1 = torch.nn.ReLU(inplace=True)
-        self.conv2 = torch.nn.Conv2d(32, 64, 4, 2)
+        self.conv2 = torch.nn.Conv2d(c1, c2, k2, s2)
         self.relu2 = torch.nn.ReLU(inplace=True)
-        self.conv3 = torch.nn.Conv2d(64, 64, 3, 1)
+        self.conv3 = torch.nn.Conv2d(c2, c3, k3, s3)
         self.relu3 = torch.nn.ReLU(inplace=True)
-        self.fc4 = torch.nn.Linear(3136, 512) 
+        self.fc4 = torch.nn.Linear(conv_output_size(self.opt, [self.conv1, self.conv2, self.conv3]), 512) 
         self.relu4 = torch.nn.ReLU(inplace=True)
         self.fc5 = torch.nn.Linear(512, self.opt.n_actions)
 
@@ -145,6 +151,35 @@ class ReplayMemory():
         return sample_batch
 
 
+    def save(self, path):
+        """
+        Write the replay memory to a compressed snapshot directory.
+
+        Arguments:
+            path (str): snapshot directory
+        """
+        save_replay_snapshot(self, path)
+
+
+    def load(self, path):
+        """
+        Fill the replay memory from a snapshot directory. Only the newest
+        transitions that fit in the replay memory are read.
+
+        Arguments:
+            path (str): snapshot directory
+
+        Returns:
+            int: number of experiences loaded
+        """
+        skip = max(0, read_snapshot_index(path)['size'] - self.capacity)
+        n_loaded = 0
+        for transition in iter_replay_snapshot(path, skip=skip):
+            self.add(Experience(*transition))
+            n_loaded += 1
+        return n_loaded
+
+
 
 class DQNAgent:
 
@@ -156,6 +191,9 @@ class DQNAgent:
 
         # Replay memory buffer
         self.replay_memory = ReplayMemory(self.opt)
+        if self.opt.mode == 'train' and self.opt.load_replay:
+            n_loaded = self.replay_memory.load(self.opt.load_replay)
+            print(f"Loaded {n_loaded} experiences from {self.opt.load_replay}")
 
         # Epsilon used for selecting actions
         self.epsilon = np.linspace(
@@ -177,22 +215,36 @@ class DQNAgent:
         if CUDA_DEVICE:
             self.net = self.net.cuda()
 
-        # The optimizer
-        self.optimizer = torch.optim.Adam(
-            self.net.parameters(),
-            lr=self.opt.learning_rate
-        )
+        # The optimizer (only needed, and slow to import, when training)
+        self.optimizer = None
+        if self.opt.mode == 'train':
+            self.optimizer = torch.optim.Adam(
+                self.net.parameters(),
+                lr=self.opt.learning_rate
+            )
 
-        # The flappy bird game instance
-        self.game = Game(self.opt.frame_size) 
+        # The flappy bird game instance (evaluation builds its own games, offline
+        # training needs none)
+        self.game = None
+        if self.opt.mode == 'train' and not self.opt.offline_data:
+            self.game = Game(self.opt.frame_size)
 
         # Log to tensorBoard
         if self.opt.mode == 'train':
-            self.writer = SummaryWriter(self.opt.exp_name)
+            self.metrics = MetricsLogger(self.opt)
 
         # Loss
         self.loss = torch.nn.MSELoss()
 
+        # Trajectory recording for offline training
+        self.recorder = make_recorder(self.opt) if self.opt.mode == 'train' else None
+
+        # Per-phase timing of the training loop
+        self.timer = PhaseTimer()
+
+        # Memory usage reporting and budget enforcement
+        self.memory_monitor = MemoryMonitor(self.opt)
+
 
     def select_action(self, state, step):
         """
@@ -223,49 +275,91 @@ class DQNAgent:
             return torch.argmax(self.net(state)[0])
 
 
-    def optimize_model(self):
+    def optimize_model(self, batch=None):
         """
         Performs a single step of optimization.
-        Samples a minibatch from replay memory and uses that to update the net.
+        Samples a minibatch from replay memory (unless one is given) and uses
+        that to update the net.
+
+        Arguments:
+            batch (dict): minibatch to learn from, e.g. from recorded trajectories
 
         Returns:
             loss (float)
         """
         # Sample a batch [state, action, reward, next_state]
-        batch = self.replay_memory.sample(self.opt.batch_size)
+        if batch is None:
+            with self.timer.phase('collate'):
+                batch = self.replay_memory.sample(self.opt.batch_size)
         if batch is None:
             return
 
-        # Compute Q(s_t, a) 
-        q_batch = torch.gather(self.net(batch['state']), 1, batch['action'])
-        q_batch = q_batch.squeeze()
-
-        # Compute V(s_{t+1}) for all next states
-        q_batch_1, _ = torch.max(self.net(batch['next_state']), dim=1)
-        y_batch = torch.tensor(
-            [batch['reward'][i] if batch['done'][i] else 
-            batch['reward'][i] + self.opt.discount_factor * q_batch_1[i] 
-            for i in range(self.opt.batch_size)]
-        )
-        if CUDA_DEVICE:
-            y_batch = y_batch.cuda()
-        y_batch = y_batch.detach()
+        with self.timer.phase('forward'):
+            # Q-values in bfloat16 under mixed precision, the loss in float32
+            with self.autocast():
+                q_values = self.net(batch['state']).float()
+                q_values_1 = self.net(batch['next_state']).float()
+
+            # Compute Q(s_t, a) 
+            q_batch = torch.gather(q_values, 1, batch['action'])
+            q_batch = q_batch.squeeze()
+
+            # Compute V(s_{t+1}) for all next states
+            q_batch_1, _ = torch.max(q_values_1, dim=1)
+            y_batch = torch.tensor(
+                [batch['reward'][i] if batch['done'][i] else 
+                batch['reward'][i] + self.opt.discount_factor * q_batch_1[i] 
+                for i in range(self.opt.batch_size)]
+            )
+            if CUDA_DEVICE:
+                y_batch = y_batch.cuda()
+            y_batch = y_batch.detach()
 
-        # Compute loss
-        loss = self.loss(q_batch, y_batch)
+            # Compute loss
+            loss = self.loss(q_batch, y_batch)
 
         # Optimize model
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        with self.timer.phase('backward'):
+            self.optimizer.zero_grad()
+            loss.backward()
+            self.optimizer.step()
+        self.timer.update()
 
         return loss
 
 
+    def autocast(self):
+        """
+        Returns:
+            context manager: bfloat16 autocast of the forward pass if
+            options.mixed_precision is set, else a no-op
+        """
+        device = 'cuda' if CUDA_DEVICE else 'cpu'
+        return torch.autocast(device, dtype=torch.bfloat16, enabled=bool(self.opt.mixed_precision))
+
+
+    def memory_usage(self):
+        """
+        Bytes held by the agent's buffers and network.
+
+        Returns:
+            dict: name -> bytes
+        """
+        return {
+            'replay_memory': tensor_bytes(
+                t for e in self.replay_memory.memory for t in (e.state, e.next_state)
+            ),
+            'network': module_bytes(self.net, self.optimizer)
+        }
+
+
     def train(self):
         """
         Main training loop.
         """
+        if self.opt.offline_data:
+            return self.train_offline()
+
         # Episode lengths
         eplen = 0
 
@@ -274,17 +368,22 @@ class DQNAgent:
         state = torch.cat([frame for i in range(self.opt.len_agent_history)])
 
         # Start a training episode
-        for i in range(1, self.opt.n_train_iterations):
+        for i in range(self.opt.start_iteration, self.opt.n_train_iterations):
 
             # Perform an action
-            action = self.select_action(state, i)
-            frame, reward, done = self.game.step(action)
-            next_state = torch.cat([state[1:], frame])
+            with self.timer.phase('act'):
+                action = self.select_action(state, i)
+            with self.timer.phase('env_step'):
+                frame, reward, done = self.game.step(action)
+                next_state = torch.cat([state[1:], frame])
 
             # Save experience to replay memory
-            self.replay_memory.add(
-                Experience(state, action, reward, next_state, done)
-            )
+            with self.timer.phase('memory'):
+                self.replay_memory.add(
+                    Experience(state, action, reward, next_state, done)
+                )
+                if self.recorder is not None:
+                    self.recorder.record(0, state, action, reward, frame, done)
 
             # Perform optimization
             loss = self.optimize_model()
@@ -294,46 +393,94 @@ class DQNAgent:
 
             # Save network
             if i % self.opt.save_frequency == 0:
-                if not os.path.exists(self.opt.exp_name):
-                    os.mkdir(self.opt.exp_name)
-                torch.save(self.net.state_dict(), f'{self.opt.exp_name}/{str(i).zfill(7)}.pt')
+                with self.timer.phase('checkpoint'):
+                    if not os.path.exists(self.opt.exp_name):
+                        os.mkdir(self.opt.exp_name)
+                    torch.save(self.net.state_dict(), f'{self.opt.exp_name}/{str(i).zfill(7)}.pt')
+                    if self.opt.save_replay:
+                        self.replay_memory.save(self.opt.save_replay)
+
+            with self.timer.phase('logging'):
+                # Write results to log
+                if i % self.opt.log_frequency == 0:
+                    self.metrics.add_scalar('loss', loss, i)
+                    self.timer.report(self.metrics, i)
+                if i % self.opt.memory_report_frequency == 0:
+                    self.memory_monitor.check(self.memory_usage(), self.metrics, i)
+
+                eplen += 1
+                self.metrics.add_steps(1)
+                if done:
+                    self.metrics.add_episode(eplen, i)
+                    eplen = 0
 
-            # Write results to log
-            if i % self.opt.log_frequency == 0:
-                self.writer.add_scalar('loss', loss, i)
+            self.timer.step()
 
-            eplen += 1
-            if done:
-                self.writer.add_scalar('episode_length', eplen, i)
-                eplen = 0
+        if self.recorder is not None:
+            self.recorder.close()
+        self.metrics.close()
 
 
-    def play_game(self):
+    def train_offline(self):
         """
-        Play Flappy Bird using the trained network.
+        Training loop learning from the recorded trajectories in
+        options.offline_data instead of playing the game.
         """
-        with torch.no_grad(): 
-            # Initialize the environment and state (do nothing)
-            frame, reward, done = self.game.step(0)
-            state = torch.cat([frame for i in range(self.opt.len_agent_history)])
+        batches = offline_batches(self.opt)
+        for i in range(self.opt.start_iteration, self.opt.n_train_iterations):
 
-            # Start playing
-            while True:
-
-                # Perform an action
-                state = state.unsqueeze(0)
-                if CUDA_DEVICE:
-                    state = state.cuda()
-                action = torch.argmax(self.net(state)[0])
-                frame, reward, done = self.game.step(action)
+            # Next minibatch, prepared by the prefetch thread
+            with self.timer.phase('collate'):
+                batch = next(batches)
                 if CUDA_DEVICE:
-                    frame = frame.cuda()
-                next_state = torch.cat([state[0][1:], frame])
+                    batch = {key: value.cuda() for key, value in batch.items()}
 
-                # Move on to the next state
-                state = next_state
+            # Perform optimization
+            loss = self.optimize_model(batch)
 
-                # If we lost, exit
-                if done:
-                    break
+            # Save network
+            if i % self.opt.save_frequency == 0:
+                with self.timer.phase('checkpoint'):
+                    if not os.path.exists(self.opt.exp_name):
+                        os.mkdir(self.opt.exp_name)
+                    torch.save(self.net.state_dict(), f'{self.opt.exp_name}/{str(i).zfill(7)}.pt')
+
+            # Write results to log
+            with self.timer.phase('logging'):
+                if i % self.opt.log_frequency == 0:
+                    self.metrics.add_scalar('loss', loss, i)
+                    self.timer.report(self.metrics, i)
 
+            self.timer.step()
+
+        self.metrics.close()
+
+
+    def policy(self, states, greedy=True):
+        """
+        Select actions for a batch of states.
+
+        Arguments:
+            states (tensor): minibatch of stacked states
+            greedy (bool): if False, act randomly with probability final_exploration
+
+        Returns:
+            tensor: action for each state, 0 if no flap, 1 if flap
+        """
+        if CUDA_DEVICE:
+            states = states.cuda()
+        actions = torch.argmax(self.net(states), dim=1).cpu()
+        if not greedy:
+            explore = torch.rand(len(actions)) <= self.opt.final_exploration
+            actions[explore] = torch.randint(self.opt.n_actions, (int(explore.sum()),))
+        return actions
+
+
+    def play_game(self):
+        """
+        Play Flappy Bird using the trained network.
+
+        Returns:
+            dict: score and episode length statistics
+        """
+        return evaluate(self, self.opt)
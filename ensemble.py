@@ -0,0 +1,567 @@
+"""
+Vectorized multi-seed training.
+Trains K independently initialized copies of DQN or ActorCriticNetwork as
+one stacked ensemble in a single process: the parameters of the copies are
+stacked along a new leading dimension and every forward pass runs all K
+models at once with torch.func.vmap, so the per-step Python and kernel
+launch overhead is paid once instead of K times.
+
+Each model gets its own games, its own replay memory (DQN), its own
+checkpoints and its own logs (losses, episodes, steps per second) in
+exp_name/seed_<k>. A single Adam optimizer over the stacked parameters is
+equivalent to K independent ones, since Adam's update is elementwise; the
+loss is the sum of the per-model losses and gradients are clipped per
+model, so no model's update depends on the others.
+"""
+
+import os
+import copy
+import random
+import argparse
+import numpy as np
+
+import torch
+from torch.func import stack_module_state, functional_call, vmap
+
+from evaluate import make_games
+from metrics import MetricsLogger
+from profiling import PhaseTimer
+from trajectories import make_recorder
+from memory_telemetry import MemoryMonitor, tensor_bytes, module_bytes
+
+
+
+class StackedEnsemble(torch.nn.Module):
+
+    def __init__(self, models, group_size):
+        """
+        Initialize an ensemble from K models of the same architecture.
+
+        Inputs are batches of K * group_size rows (or a multiple of it) in
+        which row r belongs to model (r % (K * group_size)) // group_size,
+        i.e. the layout of a rollout of K * n_workers workers where the first
+        n_workers workers belong to model 0, the next ones to model 1, etc.
+        """
+        super(StackedEnsemble, self).__init__()
+
+        self.n_models = len(models)
+        self.group_size = group_size
+
+        params, buffers = stack_module_state(models)
+        self.names = list(params.keys())
+        self.params = torch.nn.ParameterList([torch.nn.Parameter(params[name]) for name in self.names])
+        self.buffers_ = buffers
+
+        # Stateless copy of the architecture used for the functional calls
+        self.base = [copy.deepcopy(models[0]).to('meta')]
+
+
+    def model_state_dict(self, k):
+        """
+        Extract the weights of one model.
+
+        Arguments:
+            k (int): model index
+
+        Returns:
+            dict: state dict loadable by the single-model network
+        """
+        state = {name: param[k].detach().clone() for name, param in zip(self.names, self.params)}
+        state.update({name: buffer[k].clone() for name, buffer in self.buffers_.items()})
+        return state
+
+
+    def per_model(self, x, group_size):
+        """
+        Regroup rows of x from the rollout layout to (K, rows per model, ...).
+        """
+        x = x.view(-1, self.n_models, group_size, *x.shape[1:]).transpose(0, 1)
+        return x.reshape(self.n_models, -1, *x.shape[3:])
+
+
+    def rollout_layout(self, y, group_size):
+        """
+        Inverse of per_model(): regroup (K, rows per model, ...) to rollout rows.
+        """
+        y = y.view(self.n_models, -1, group_size, *y.shape[2:]).transpose(0, 1)
+        return y.reshape(-1, *y.shape[3:])
+
+
+    def forward(self, x, group_size=None):
+        """
+        Forward pass of all models.
+
+        Arguments:
+            x (tensor): minibatch of input states in rollout layout
+            group_size (int): rows per model per block, defaults to the ensemble's
+
+        Returns:
+            tensor or tuple: outputs of the models in rollout layout
+        """
+        group_size = group_size or self.group_size
+        params = {name: param for name, param in zip(self.names, self.params)}
+
+        def call(params, buffers, x):
+            return functional_call(self.base[0], (params, buffers), (x,))
+
+        out = vmap(call)(params, self.buffers_, self.per_model(x, group_size))
+        if isinstance(out, tuple):
+            return tuple(self.rollout_layout(y, group_size) for y in out)
+        return self.rollout_layout(out, group_size)
+
+
+    def act(self, x):
+        """
+        Sample actions for a batch of states, like ActorCriticNetwork.act.
+
+        Returns:
+            tensor: values
+            tensor: sampled actions
+            tensor: log probabilities of the sampled actions
+        """
+        values, action_logits = self.forward(x)
+        probs = torch.softmax(action_logits, dim=-1)
+        log_probs = torch.log_softmax(action_logits, dim=-1)
+        actions = probs.multinomial(1)
+        return values, actions, log_probs.gather(1, actions)
+
+
+    def evaluate_actions(self, x, actions):
+        """
+        Evaluate actions for a batch of states, like ActorCriticNetwork.evaluate_actions.
+
+        Returns:
+            tensor: values
+            tensor: log probabilities of the actions
+            tensor: mean entropy of the action distributions of each model, size (K,)
+        """
+        values, action_logits = self.forward(x)
+        probs = torch.softmax(action_logits, dim=-1)
+        log_probs = torch.log_softmax(action_logits, dim=-1)
+        entropy = -(log_probs * probs).sum(-1, keepdim=True)
+        dist_entropy = self.per_model(entropy, self.group_size).mean(dim=(1, 2))
+        return values, log_probs.gather(1, actions), dist_entropy
+
+
+    def scale_and_clip_gradients(self, scale, max_norm=None):
+        """
+        Multiply the gradients by scale, then clip each model's gradient norm
+        separately.
+
+        Arguments:
+            scale (float): gradient scale, K undoes averaging a loss over all models
+            max_norm (float): norm bound per model, no clipping if None
+        """
+        grads = [p.grad for p in self.params if p.grad is not None]
+        for g in grads:
+            g.mul_(scale)
+        if max_norm is None:
+            return
+        norms = torch.stack([g.view(self.n_models, -1).pow(2).sum(1) for g in grads]).sum(0).sqrt()
+        factors = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+        for g in grads:
+            g.mul_(factors.view(-1, *([1] * (g.dim() - 1))))
+
+
+
+def make_ensemble(options, net_class, seeds, group_size):
+    """
+    Build K independently initialized networks and stack them.
+
+    Arguments:
+        options (argparse.Namespace): run options
+        net_class (class): DQN or ActorCriticNetwork
+        seeds (list): one initialization seed per model
+        group_size (int): rows per model per block of input
+
+    Returns:
+        StackedEnsemble: the ensemble
+    """
+    models = []
+    for seed in seeds:
+        torch.manual_seed(seed)
+        net = net_class(options)
+        net.apply(net.init_weights)
+        models.append(net)
+    return StackedEnsemble(models, group_size)
+
+
+def ensemble_seeds(options):
+    """
+    Returns:
+        list: seed of each model of the ensemble
+    """
+    base = options.seed if options.seed is not None else 0
+    return [base + k for k in range(options.n_seeds)]
+
+
+
+class EnsembleActorCriticMixin():
+
+    def build_ensemble(self, options):
+        """
+        Replace the agent's network and optimizer by a stacked ensemble of
+        options.n_seeds models, each driving options.n_workers games.
+        """
+        self.seeds = ensemble_seeds(options)
+        self.workers_per_model = options.n_workers // options.n_seeds
+        self.net = make_ensemble(options, type(self.net), self.seeds, self.workers_per_model)
+        if torch.cuda.is_available():
+            self.net = self.net.cuda()
+        self.optimizer = torch.optim.Adam(self.net.parameters(), lr=self.opt.learning_rate)
+
+        # One log directory per model
+        self.seed_metrics = [
+            MetricsLogger(self.opt, os.path.join(self.opt.exp_name, f'seed_{seed}')) for seed in self.seeds
+        ]
+
+
+    def loss_mean(self, x):
+        """
+        Average a loss term over the rollout, separately for each model.
+
+        Arguments:
+            x (tensor): loss term of size (buffer_update_freq, n_workers, 1)
+
+        Returns:
+            tensor: mean of the term for each model, size (K,)
+        """
+        return x.view(x.size(0), self.net.n_models, self.workers_per_model, -1).mean(dim=(0, 2, 3))
+
+
+    def clip_gradients(self):
+        """
+        Clip each model's gradient norm separately.
+        """
+        self.net.scale_and_clip_gradients(1.0, self.opt.max_grad_norm)
+
+
+    def normalize_returns(self, returns):
+        """
+        Normalize returns to zero mean and unit variance, separately for each model.
+        """
+        returns = returns.view(returns.size(0), self.net.n_models, self.workers_per_model, 1)
+        mean = returns.mean(dim=(0, 2, 3), keepdim=True)
+        std = returns.std(dim=(0, 2, 3), keepdim=True)
+        return ((returns - mean) / (std + 1e-5)).view(returns.size(0), -1, 1)
+
+
+    def log_episode(self, worker, length, step):
+        """
+        Log the length of a finished episode to the log of the worker's model.
+        """
+        self.metrics.add_episode(length, step)
+        self.seed_metrics[worker // self.workers_per_model].add_episode(length, step)
+
+
+    def log_steps(self, n_steps):
+        """
+        Count environment steps, split evenly over the models.
+        """
+        self.metrics.add_steps(n_steps)
+        for metrics in self.seed_metrics:
+            metrics.add_steps(n_steps // self.net.n_models)
+
+
+    def log_losses(self, losses, step):
+        """
+        Log the mean losses over the models to the main log and the losses
+        of each model to its own log.
+        """
+        for name, value in losses.items():
+            if value is None:
+                continue
+            value = value.detach()
+            self.metrics.add_scalar('loss/' + name, value.mean(), step)
+            for k, metrics in enumerate(self.seed_metrics):
+                metrics.add_scalar('loss/' + name, value[k], step)
+
+
+    def save_checkpoint(self, step):
+        """
+        Save the weights of every model to exp_name/seed_<k>/<step>.pt.
+        """
+        for k, seed in enumerate(self.seeds):
+            save_dir = os.path.join(self.opt.exp_name, f'seed_{seed}')
+            if not os.path.exists(save_dir):
+                os.makedirs(save_dir)
+            torch.save(self.net.model_state_dict(k), f'{save_dir}/{str(step).zfill(7)}.pt')
+
+
+    def train(self):
+        """
+        Main training loop, shared by all models of the ensemble.
+        """
+        super().train()
+        for metrics in self.seed_metrics:
+            metrics.close()
+
+
+def ensemble_options(options):
+    """
+    Copy the run options with one set of n_workers games per model.
+    """
+    options = argparse.Namespace(**vars(options))
+    options.n_workers = options.n_workers * options.n_seeds
+    return options
+
+
+def make_ensemble_agent(options):
+    """
+    Create a vectorized multi-seed agent for options.algo.
+
+    Arguments:
+        options (argparse.Namespace): run options, options.n_seeds models are trained
+
+    Returns:
+        agent: agent training the stacked ensemble
+    """
+    # A single checkpoint would make every model identical, which defeats
+    # training independent seeds
+    if options.weights_dir:
+        raise ValueError("--weights_dir loads a single model, it is not supported with --n_seeds > 1")
+
+    if options.algo == 'dqn':
+        return EnsembleDQNAgent(options)
+
+    if options.algo == 'a2c':
+        from a2c import A2CAgent as Agent
+    else:
+        from ppo import PPOAgent as Agent
+
+    class EnsembleAgent(EnsembleActorCriticMixin, Agent):
+
+        def __init__(self, options):
+            options = ensemble_options(options)
+            super().__init__(options)
+            self.build_ensemble(options)
+
+    return EnsembleAgent(options)
+
+
+
+class EnsembleDQNAgent():
+
+    def __init__(self, options):
+        """
+        Initialize a vectorized multi-seed DQN agent: K stacked Q-networks,
+        each with its own game and replay memory.
+        """
+        from dqn import DQN, ReplayMemory
+
+        if options.offline_data:
+            raise ValueError("--offline_data trains a single model, it is not supported with --n_seeds > 1")
+
+        self.opt = options
+        self.seeds = ensemble_seeds(options)
+        self.n_models = len(self.seeds)
+
+        # One replay memory per model. A snapshot warm-starts all of them, the
+        # loaded transitions are shared since experiences are never modified.
+        self.replay_memories = [ReplayMemory(self.opt) for _ in self.seeds]
+        if self.opt.load_replay:
+            n_loaded = self.replay_memories[0].load(self.opt.load_replay)
+            for memory in self.replay_memories[1:]:
+                memory.memory = list(self.replay_memories[0].memory)
+            print(f"Loaded {n_loaded} experiences from {self.opt.load_replay} into each of {self.n_models} replay memories")
+
+        # Epsilon used for selecting actions
+        self.epsilon = np.linspace(
+            self.opt.initial_exploration,
+            self.opt.final_exploration,
+            self.opt.final_exploration_frame
+        )
+
+        self.net = make_ensemble(options, DQN, self.seeds, 1)
+        if torch.cuda.is_available():
+            self.net = self.net.cuda()
+        self.optimizer = torch.optim.Adam(self.net.parameters(), lr=self.opt.learning_rate)
+
+        self.games = make_games(self.opt.frame_size, self.n_models, self.opt.game_init_threads)
+
+        # One log directory per model, next to the main log
+        self.metrics = MetricsLogger(self.opt)
+        self.seed_metrics = [
+            MetricsLogger(self.opt, os.path.join(self.opt.exp_name, f'seed_{seed}')) for seed in self.seeds
+        ]
+
+        # Trajectory recording, one stream per model
+        self.recorder = make_recorder(self.opt)
+
+        self.timer = PhaseTimer()
+        self.memory_monitor = MemoryMonitor(self.opt)
+
+
+    def autocast(self):
+        """
+        Returns:
+            context manager: bfloat16 autocast of the forward pass if
+            options.mixed_precision is set, else a no-op
+        """
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        return torch.autocast(device, dtype=torch.bfloat16, enabled=bool(self.opt.mixed_precision))
+
+
+    def memory_usage(self):
+        """
+        Bytes held by the replay memories and the stacked networks.
+
+        Returns:
+            dict: name -> bytes
+        """
+        return {
+            'replay_memory': tensor_bytes(
+                t for memory in self.replay_memories for e in memory.memory for t in (e.state, e.next_state)
+            ),
+            'network': module_bytes(self.net, self.optimizer)
+        }
+
+
+    def select_actions(self, states, step):
+        """
+        Epsilon-greedy action selection for the state of every model.
+
+        Arguments:
+            states (tensor): one stacked state per model
+            step (int): the current training step
+
+        Returns:
+            list: one action per model
+        """
+        if torch.cuda.is_available():
+            states = states.cuda()
+        step = min(step, self.opt.final_exploration_frame - 1)
+        epsilon = self.epsilon[step]
+
+        with torch.no_grad():
+            actions = torch.argmax(self.net(states, group_size=1), dim=1).tolist()
+        for k in range(self.n_models):
+            if random.random() <= epsilon:
+                actions[k] = np.random.choice(self.opt.n_actions, p=[0.95, 0.05])
+        return actions
+
+
+    def optimize_model(self):
+        """
+        Performs a single step of optimization of every model, each on a
+        minibatch sampled from its own replay memory.
+
+        Returns:
+            tensor: per-model losses, None if the replay memories are too small
+        """
+        with self.timer.phase('collate'):
+            batches = [memory.sample(self.opt.batch_size) for memory in self.replay_memories]
+        if any(batch is None for batch in batches):
+            return
+
+        with self.timer.phase('forward'):
+            batch = {key: torch.cat([b[key] for b in batches]) for key in batches[0]}
+            group_size = self.opt.batch_size
+
+            # Compute Q(s_t, a) and the TD targets r + gamma * max_a Q(s_{t+1}, a)
+            with self.autocast():
+                q_values = self.net(batch['state'], group_size).float()
+                with torch.no_grad():
+                    q_values_1 = self.net(batch['next_state'], group_size).float()
+            q_batch = torch.gather(q_values, 1, batch['action']).squeeze(1)
+            with torch.no_grad():
+                q_batch_1, _ = torch.max(q_values_1, dim=1)
+                done = batch['done'].float()
+                y_batch = batch['reward'].float() + (1 - done) * self.opt.discount_factor * q_batch_1
+
+            # Sum of the per-model MSE losses, so each model gets its own gradient
+            losses = (q_batch - y_batch).pow(2).view(self.n_models, -1).mean(1)
+            loss = losses.sum()
+
+        with self.timer.phase('backward'):
+            self.optimizer.zero_grad()
+            loss.backward()
+            self.optimizer.step()
+        self.timer.update()
+
+        return losses.detach()
+
+
+    def save_checkpoint(self, step):
+        """
+        Save the weights of every model to exp_name/seed_<k>/<step>.pt, and
+        its replay memory to save_replay/seed_<k> if requested.
+        """
+        for k, seed in enumerate(self.seeds):
+            save_dir = os.path.join(self.opt.exp_name, f'seed_{seed}')
+            if not os.path.exists(save_dir):
+                os.makedirs(save_dir)
+            torch.save(self.net.model_state_dict(k), f'{save_dir}/{str(step).zfill(7)}.pt')
+            if self.opt.save_replay:
+                self.replay_memories[k].save(os.path.join(self.opt.save_replay, f'seed_{seed}'))
+
+
+    def train(self):
+        """
+        Main training loop, stepping the game of every model in lockstep.
+        """
+        from dqn import Experience
+
+        eplens = [0] * self.n_models
+
+        # Initialize the environments and states (do nothing)
+        states = []
+        for game in self.games:
+            frame, reward, done = game.step(0)
+            states.append(torch.cat([frame for i in range(self.opt.len_agent_history)]))
+
+        for i in range(self.opt.start_iteration, self.opt.n_train_iterations):
+
+            # Perform an action in every game
+            with self.timer.phase('act'):
+                actions = self.select_actions(torch.stack(states), i)
+            with self.timer.phase('env_step'):
+                steps = [game.step(action) for game, action in zip(self.games, actions)]
+
+            # Save experiences to the replay memory of each model
+            with self.timer.phase('memory'):
+                next_states = []
+                for k, (frame, reward, done) in enumerate(steps):
+                    next_state = torch.cat([states[k][1:], frame])
+                    self.replay_memories[k].add(Experience(states[k], actions[k], reward, next_state, done))
+                    if self.recorder is not None:
+                        self.recorder.record(k, states[k], actions[k], reward, frame, done)
+                    next_states.append(next_state)
+
+            # Perform optimization
+            losses = self.optimize_model()
+
+            # Move on to the next states
+            states = next_states
+
+            # Save networks
+            if i % self.opt.save_frequency == 0:
+                with self.timer.phase('checkpoint'):
+                    self.save_checkpoint(i)
+
+            with self.timer.phase('logging'):
+                if i % self.opt.log_frequency == 0:
+                    self.timer.report(self.metrics, i)
+                    if losses is not None:
+                        self.metrics.add_scalar('loss', losses.mean(), i)
+                        for k in range(self.n_models):
+                            self.seed_metrics[k].add_scalar('loss', losses[k], i)
+                if i % self.opt.memory_report_frequency == 0:
+                    self.memory_monitor.check(self.memory_usage(), self.metrics, i)
+
+                self.metrics.add_steps(self.n_models)
+                for k, (_, _, done) in enumerate(steps):
+                    self.seed_metrics[k].add_steps(1)
+                    eplens[k] += 1
+                    if done:
+                        self.metrics.add_episode(eplens[k], i)
+                        self.seed_metrics[k].add_episode(eplens[k], i)
+                        eplens[k] = 0
+
+            self.timer.step()
+
+        if self.recorder is not None:
+            self.recorder.close()
+        self.metrics.close()
+        for metrics in self.seed_metrics:
+            metrics.close()
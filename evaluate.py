@@ -0,0 +1,163 @@
+"""
+Batched multi-episode evaluation of a trained agent.
+Runs options.eval_episodes episodes spread over options.eval_envs games
+stepped in lockstep, with one batched forward pass per frame, and returns
+score, episode length and per-frame inference latency distributions.
+"""
+
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from game.wrapper import Game
+from trajectories import make_recorder
+
+PERCENTILES = (5, 25, 50, 75, 95, 99)
+
+
+
+def summarize(values):
+    """
+    Summarize a list of per-episode values.
+
+    Arguments:
+        values (list): one value per episode
+
+    Returns:
+        dict: mean, std, min, max and percentiles
+    """
+    values = np.asarray(values, dtype=np.float64)
+    summary = {
+        'mean': float(values.mean()),
+        'std': float(values.std()),
+        'min': float(values.min()),
+        'max': float(values.max())
+    }
+    for p in PERCENTILES:
+        summary[f'p{p}'] = float(np.percentile(values, p))
+    return summary
+
+
+def make_games(frame_size, n_games, n_threads=1):
+    """
+    Construct games, optionally in several threads to overlap their asset
+    loading. The pygame/SDL game is not thread-safe on every platform, so
+    games are built one after the other unless n_threads > 1 is asked for.
+
+    Arguments:
+        frame_size (int): size of the game frames in pixels
+        n_games (int): number of games
+        n_threads (int): number of threads constructing games
+
+    Returns:
+        list: Game instances
+    """
+    if n_threads <= 1 or n_games <= 1:
+        return [Game(frame_size) for _ in range(n_games)]
+    with ThreadPoolExecutor(min(n_games, n_threads)) as pool:
+        return list(pool.map(lambda _: Game(frame_size), range(n_games)))
+
+
+def initial_state(game, options):
+    """
+    Start a game (do nothing) and build its first stacked state.
+
+    Returns:
+        tensor: stacked state of size (len_agent_history, frame_size, frame_size)
+    """
+    frame, _, _ = game.step(0)
+    return torch.cat([frame for _ in range(options.len_agent_history)])
+
+
+def evaluate(agent, options):
+    """
+    Evaluate an agent over several episodes and parallel games.
+    Episodes reaching options.max_episode_length are cut off, counted as
+    truncated, and their game is replaced by a fresh one.
+
+    Arguments:
+        agent (agent or InferencePolicy): anything exposing policy(states, greedy)
+        options (argparse.Namespace): evaluation options
+
+    Returns:
+        dict: episode score/length distributions and throughput
+    """
+    n_episodes = options.eval_episodes
+    n_envs = min(options.eval_envs, n_episodes)
+    greedy = options.eval_policy == 'greedy'
+
+    games = make_games(options.frame_size, n_envs, options.game_init_threads)
+    states = torch.stack([initial_state(game, options) for game in games])
+
+    # Per-game episode bookkeeping
+    active = np.ones(n_envs, dtype=np.bool_)
+    lengths = np.zeros(n_envs, dtype=np.int64)
+    returns = np.zeros(n_envs, dtype=np.float64)
+    pipes = np.zeros(n_envs, dtype=np.int64)
+    n_started = n_envs
+
+    episode_lengths, episode_returns, episode_pipes = [], [], []
+    n_truncated, n_frames = 0, 0
+    inference_ms = []
+    recorder = make_recorder(options)
+    start = time.perf_counter()
+
+    with torch.no_grad():
+        while active.any():
+            idx = np.flatnonzero(active)
+            inference_start = time.perf_counter()
+            actions = agent.policy(states[idx], greedy).tolist()
+            inference_ms.append((time.perf_counter() - inference_start) * 1e3)
+
+            frames, restarted = [], {}
+            for k, action in zip(idx.tolist(), actions):
+                frame, reward, done = games[k].step(action)
+                frames.append(frame)
+                if recorder is not None:
+                    recorder.record(k, states[k], action, reward, frame, done)
+                lengths[k] += 1
+                returns[k] += reward
+                pipes[k] += reward >= 1
+                n_frames += 1
+
+                truncated = bool(not done and lengths[k] >= options.max_episode_length)
+                if not (done or truncated):
+                    continue
+
+                # Record the finished episode
+                episode_lengths.append(int(lengths[k]))
+                episode_returns.append(float(returns[k]))
+                episode_pipes.append(int(pipes[k]))
+                lengths[k], returns[k], pipes[k] = 0, 0.0, 0
+                n_truncated += truncated
+
+                # Start another episode in this game (a fresh one if it was cut off), or retire it
+                if n_started < n_episodes:
+                    n_started += 1
+                    if truncated:
+                        games[k] = Game(options.frame_size)
+                        restarted[k] = initial_state(games[k], options)
+                else:
+                    active[k] = False
+
+            states[idx] = torch.cat([states[idx, 1:], torch.stack(frames)], dim=1)
+            for k, state in restarted.items():
+                states[k] = state
+
+    elapsed = time.perf_counter() - start
+    if recorder is not None:
+        recorder.close()
+    return {
+        'n_episodes': len(episode_lengths),
+        'n_envs': n_envs,
+        'policy': options.eval_policy,
+        'n_truncated': n_truncated,
+        'score': summarize(episode_pipes),
+        'return': summarize(episode_returns),
+        'episode_length': summarize(episode_lengths),
+        'inference_ms': summarize(inference_ms),
+        'frames_per_second': n_frames / elapsed,
+        'elapsed_s': elapsed
+    }
@@ -0,0 +1,276 @@
+"""
+Inference export of trained networks.
+Builds a forward-only policy network (the Q-values of DQN, or the action
+logits of ActorCriticNetwork without the critic head), freezes it and
+saves it as TorchScript or ONNX. InferencePolicy loads such an artifact,
+fusing conv+ReLU for TorchScript, with a preallocated channels_last input
+buffer; it can be used by the evaluator in place of an agent.
+"""
+
+import copy
+import json
+import time
+import numpy as np
+
+import torch
+
+METADATA_FILE = 'policy.json'
+
+
+
+def load_network(options):
+    """
+    Build the network of options.algo and load options.weights_dir into it.
+
+    Arguments:
+        options (argparse.Namespace): run options
+
+    Returns:
+        torch.nn.Module: trained network in eval mode
+    """
+    if options.algo == 'dqn':
+        from dqn import DQN as Network
+    elif options.algo == 'a2c':
+        from a2c import ActorCriticNetwork as Network
+    else:
+        from ppo import ActorCriticNetwork as Network
+
+    net = Network(options)
+    net.load_state_dict(torch.load(options.weights_dir, map_location=torch.device('cpu')))
+    return net.eval()
+
+
+def policy_network(net):
+    """
+    Rebuild a trained network as a plain forward-only stack of layers which
+    outputs one score per action.
+
+    Arguments:
+        net (DQN or ActorCriticNetwork): trained network
+
+    Returns:
+        tuple: (torch.nn.Sequential, kind) where kind is 'q_values' or 'logits'
+    """
+    layers, kind = [], 'logits' if hasattr(net, 'actor') else 'q_values'
+    for name, module in copy.deepcopy(net).named_children():
+        if name in ('critic', 'softmax', 'logsoftmax') or isinstance(module, torch.nn.ReLU):
+            continue
+        if isinstance(module, torch.nn.Linear) and not any(isinstance(l, torch.nn.Flatten) for l in layers):
+            layers.append(torch.nn.Flatten())
+        layers.append(module)
+        if name not in ('actor', 'fc5'):
+            layers.append(torch.nn.ReLU())
+    return torch.nn.Sequential(*layers).eval(), kind
+
+
+def example_input(options, batch_size=1):
+    """
+    Returns:
+        tensor: a batch of zero states in channels_last memory format
+    """
+    shape = (batch_size, options.len_agent_history, int(options.frame_size), int(options.frame_size))
+    return torch.zeros(shape).contiguous(memory_format=torch.channels_last)
+
+
+def policy_metadata(options, kind):
+    """
+    Returns:
+        dict: metadata saved alongside an exported policy
+    """
+    return {
+        'algo': options.algo,
+        'kind': kind,
+        'format': options.export_format,
+        'len_agent_history': options.len_agent_history,
+        'frame_size': int(options.frame_size),
+        'conv_stack': options.conv_stack,
+        'n_actions': options.n_actions
+    }
+
+
+def apply_metadata(options, metadata):
+    """
+    Copy the input settings an exported policy was built for (frame size,
+    frame history, number of actions) into options, so evaluation plays
+    the game the policy expects. Settings overriding the command line are
+    reported.
+
+    Arguments:
+        options (argparse.Namespace): run options, modified in place
+        metadata (dict): export metadata of the policy
+    """
+    for name in ('frame_size', 'len_agent_history', 'n_actions'):
+        value = int(metadata[name])
+        if getattr(options, name) != value:
+            print(f"{name}: using {value} from the exported policy instead of {getattr(options, name)}")
+            setattr(options, name, value)
+
+
+def export_policy(options):
+    """
+    Export options.weights_dir to options.export_path as TorchScript or ONNX,
+    then report its per-frame latency against the eager network.
+
+    Arguments:
+        options (argparse.Namespace): run options
+
+    Returns:
+        dict: latency comparison
+    """
+    net = load_network(options)
+    policy, kind = policy_network(net)
+    policy = policy.to(memory_format=torch.channels_last)
+    x = example_input(options)
+    metadata = policy_metadata(options, kind)
+
+    if options.export_format == 'torchscript':
+        # Freezing inlines the weights as constants; the conv+ReLU fusion of
+        # optimize_for_inference is not serializable and is applied on load
+        with torch.no_grad():
+            scripted = torch.jit.freeze(torch.jit.trace(policy, x))
+        torch.jit.save(scripted, options.export_path, _extra_files={METADATA_FILE: json.dumps(metadata)})
+    else:
+        import onnx
+        torch.onnx.export(
+            policy, (x,), options.export_path,
+            input_names=['state'], output_names=['scores'],
+            dynamic_axes={'state': {0: 'batch'}, 'scores': {0: 'batch'}},
+            dynamo=False
+        )
+        model = onnx.load(options.export_path)
+        for key, value in metadata.items():
+            model.metadata_props.add(key=key, value=str(value))
+        onnx.save(model, options.export_path)
+    print(f"Exported {options.algo} policy to {options.export_path}")
+
+    # Compare against the eager training-time network
+    artifact = load_policy(options.export_path)
+    x = torch.rand(1, options.len_agent_history, int(options.frame_size), int(options.frame_size))
+    with torch.no_grad():
+        reference = net(x)[1] if kind == 'logits' else net(x)
+        eager_ms = frame_latency(lambda: net(x))
+    max_error = float((artifact.scores(x) - reference).abs().max())
+    exported_ms = frame_latency(lambda: artifact.scores(x))
+
+    results = {'max_abs_error': max_error, 'eager_ms': eager_ms, 'exported_ms': exported_ms}
+    print(json.dumps(results, indent=2))
+    return results
+
+
+def frame_latency(fn, n_frames=200, warmup=20):
+    """
+    Measure the latency of a batch-1 forward pass.
+
+    Arguments:
+        fn (function): forward pass, called without arguments
+        n_frames (int): number of timed calls
+        warmup (int): untimed calls before timing
+
+    Returns:
+        dict: p50, p99 and mean latency in milliseconds
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(n_frames):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1e3)
+    return {
+        'p50': float(np.percentile(times, 50)),
+        'p99': float(np.percentile(times, 99)),
+        'mean': float(np.mean(times))
+    }
+
+
+
+def load_policy(path, max_batch_size=64):
+    """
+    Load an exported policy: .onnx files with onnxruntime, anything else
+    as TorchScript.
+
+    Arguments:
+        path (str): exported policy file
+        max_batch_size (int): size of the preallocated input buffer
+
+    Returns:
+        InferencePolicy: the loaded policy
+    """
+    if path.endswith('.onnx'):
+        import onnx
+        import onnxruntime
+        metadata = {p.key: p.value for p in onnx.load(path).metadata_props}
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        module = lambda x: torch.from_numpy(session.run(None, {'state': x.contiguous().numpy()})[0])
+    else:
+        extra_files = {METADATA_FILE: ''}
+        module = torch.jit.load(path, map_location=torch.device('cpu'), _extra_files=extra_files)
+        metadata = json.loads(extra_files[METADATA_FILE])
+        if not metadata.get('quantized'):
+            module = torch.jit.optimize_for_inference(module)
+    return InferencePolicy(module, metadata, max_batch_size)
+
+
+
+class InferencePolicy():
+
+    def __init__(self, module, metadata, max_batch_size=64):
+        """
+        Wrap a forward-only policy network together with a preallocated
+        channels_last input buffer.
+
+        Arguments:
+            module (callable): maps a batch of states to action scores
+            metadata (dict): export metadata (kind, n_actions, input size)
+            max_batch_size (int): size of the preallocated input buffer
+        """
+        self.module = module
+        self.metadata = metadata
+        self.kind = self.metadata['kind']
+        self.n_actions = int(self.metadata['n_actions'])
+        history, size = int(self.metadata['len_agent_history']), int(self.metadata['frame_size'])
+        self.buffer = torch.zeros(max_batch_size, history, size, size).contiguous(memory_format=torch.channels_last)
+
+        # Exploration rate for stochastic evaluation of Q-value policies
+        self.epsilon = 0.0
+
+
+    def scores(self, states):
+        """
+        Compute the action scores (Q-values or logits) of a batch of states.
+
+        Arguments:
+            states (tensor): minibatch of stacked states
+
+        Returns:
+            tensor: scores of size (batch_size, n_actions)
+        """
+        n = states.size(0)
+        if n > self.buffer.size(0):
+            self.buffer = torch.zeros_like(states).contiguous(memory_format=torch.channels_last)
+        x = self.buffer[:n]
+        x.copy_(states)
+        with torch.inference_mode():
+            return self.module(x)
+
+
+    def policy(self, states, greedy=True):
+        """
+        Select actions for a batch of states, with the same interface as the agents.
+
+        Arguments:
+            states (tensor): minibatch of stacked states
+            greedy (bool): take the best action instead of sampling/exploring
+
+        Returns:
+            tensor: action for each state
+        """
+        scores = self.scores(states)
+        if greedy:
+            return torch.argmax(scores, dim=1)
+        if self.kind == 'logits':
+            return torch.softmax(scores, dim=1).multinomial(1).view(-1)
+        actions = torch.argmax(scores, dim=1)
+        explore = torch.rand(len(actions)) <= self.epsilon
+        actions[explore] = torch.randint(self.n_actions, (int(explore.sum()),))
+        return actions
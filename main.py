@@ -1,7 +1,17 @@
+import time
+START_TIME = time.perf_counter()
+
+import json
+import random
 import argparse
-from dqn import DQNAgent
-from a2c import A2CAgent
-from ppo import PPOAgent 
+import importlib
+
+# Agent class of each algorithm, imported on first use
+AGENTS = {
+    'dqn': ('dqn', 'DQNAgent'),
+    'a2c': ('a2c', 'A2CAgent'),
+    'ppo': ('ppo', 'PPOAgent')
+}
 
 
 # ARGPARSER 
@@ -15,7 +25,11 @@ parser.add_argument("--mode",
                     type=str,
                     help="run the network in train or evaluation mode",
                     default="train",
-                    choices=["train", "eval"])
+                    choices=["train", "eval", "sweep", "pbt", "export", "quantize", "autotune"])
+parser.add_argument("--config",
+                    type=str,
+                    help="JSON file of option values, e.g. written by autotune mode (command line options take precedence)",
+                    default="")
 
 # DIRECTORY options
 parser.add_argument("--exp_name",
@@ -32,6 +46,10 @@ parser.add_argument("--n_train_iterations",
                     type=int,
                     help="number of iterations to train network",
                     default=3000000) 
+parser.add_argument("--start_iteration",
+                    type=int,
+                    help="iteration to start training from, e.g. when resuming from weights_dir",
+                    default=1)
 parser.add_argument("--learning_rate",
                     type=float,
                     help="learning rate",
@@ -44,6 +62,18 @@ parser.add_argument("--discount_factor",
                     type=float,
                     help="discount factor used for discounting return",
                     default=0.99)
+parser.add_argument("--mixed_precision",
+                    type=int,
+                    help="1 to run the learner forward/backward passes in bfloat16 autocast (float32 weights and losses)",
+                    default=0)
+parser.add_argument("--seed",
+                    type=int,
+                    help="random seed (unseeded if not given)",
+                    default=None)
+parser.add_argument("--n_seeds",
+                    type=int,
+                    help="number of independently seeded models trained together as one vectorized ensemble",
+                    default=1)
 
 # DQN specific options
 parser.add_argument("--batch_size",
@@ -66,6 +96,14 @@ parser.add_argument("--replay_memory_size",
                     type=int,
                     help="maximum number of transitions in replay memory",
                     default=25000)
+parser.add_argument("--load_replay",
+                    type=str,
+                    help="replay snapshot directory to warm-start replay memory from",
+                    default="")
+parser.add_argument("--save_replay",
+                    type=str,
+                    help="directory to snapshot replay memory to at every model save",
+                    default="")
 
 # A2C/PPO specific parameters
 parser.add_argument("--n_workers",
@@ -93,6 +131,32 @@ parser.add_argument("--grad_clip",
                     help="magnitude bound for clipping gradients",
                     default=0.1)
 
+# OFFLINE DATA options
+parser.add_argument("--record_trajectories",
+                    type=str,
+                    help="directory to record the played transitions to as trajectory shards",
+                    default="")
+parser.add_argument("--trajectory_shard_size",
+                    type=int,
+                    help="number of transitions per trajectory shard",
+                    default=5000)
+parser.add_argument("--offline_data",
+                    type=str,
+                    help="trajectory directory to train DQN on offline, or to pretrain A2C/PPO on by behaviour cloning",
+                    default="")
+parser.add_argument("--offline_shuffle_buffer",
+                    type=int,
+                    help="number of transitions in the shuffle buffer of the offline data stream",
+                    default=20000)
+parser.add_argument("--offline_prefetch",
+                    type=int,
+                    help="number of minibatches prepared ahead by the offline data stream",
+                    default=4)
+parser.add_argument("--pretrain_iterations",
+                    type=int,
+                    help="behaviour cloning minibatches for A2C/PPO before online training",
+                    default=1000)
+
 # LOGGING options
 parser.add_argument("--log_frequency",
                     type=int,
@@ -102,6 +166,140 @@ parser.add_argument("--save_frequency",
                     type=int,
                     help="number of batches between each model save",
                     default=100000)
+parser.add_argument("--metrics_flush_interval",
+                    type=float,
+                    help="seconds between each flush of buffered metrics to disk",
+                    default=10.0)
+parser.add_argument("--metrics_buffer_size",
+                    type=int,
+                    help="number of scalars buffered before a forced flush",
+                    default=65536)
+parser.add_argument("--metrics_window",
+                    type=int,
+                    help="number of recent episodes used for rolling episode length stats",
+                    default=100)
+parser.add_argument("--profile",
+                    type=int,
+                    help="profile this many training iterations with torch.profiler and cProfile, then exit",
+                    default=0)
+parser.add_argument("--profile_warmup",
+                    type=int,
+                    help="minimum number of warm-up iterations before the profiled window (DQN also fills a batch of replay memory first)",
+                    default=5)
+parser.add_argument("--memory_report_frequency",
+                    type=int,
+                    help="number of batches between each memory usage report",
+                    default=1000)
+parser.add_argument("--memory_budget",
+                    type=int,
+                    help="memory budget in MB, buffers are sized to fit and the run fails if exceeded (0 for none)",
+                    default=0)
+
+# EVALUATION options
+parser.add_argument("--eval_episodes",
+                    type=int,
+                    help="number of episodes to play in eval mode",
+                    default=1)
+parser.add_argument("--eval_envs",
+                    type=int,
+                    help="number of games played in parallel in eval mode",
+                    default=1)
+parser.add_argument("--eval_policy",
+                    type=str,
+                    help="take the best action or sample actions in eval mode",
+                    default="greedy",
+                    choices=["greedy", "stochastic"])
+parser.add_argument("--max_episode_length",
+                    type=int,
+                    help="cut off evaluation episodes after this many frames",
+                    default=10000)
+parser.add_argument("--eval_output",
+                    type=str,
+                    help="file to write evaluation results to as JSON",
+                    default="")
+parser.add_argument("--inference_model",
+                    type=str,
+                    help="exported policy to play with in eval mode instead of weights_dir",
+                    default="")
+parser.add_argument("--tick_rate",
+                    type=float,
+                    help="play one game in real time at this many frames per second, with inference on its own thread (0 for batched evaluation)",
+                    default=0)
+parser.add_argument("--sweep_workers",
+                    type=int,
+                    help="number of checkpoints evaluated in parallel in sweep mode",
+                    default=4)
+
+# EXPORT options
+parser.add_argument("--export_path",
+                    type=str,
+                    help="file to write the exported inference policy to",
+                    default="policy.pt")
+parser.add_argument("--export_format",
+                    type=str,
+                    help="format of the exported inference policy",
+                    default="torchscript",
+                    choices=["torchscript", "onnx"])
+parser.add_argument("--calibration_frames",
+                    type=int,
+                    help="number of recorded game states used to calibrate int8 quantization",
+                    default=1000)
+
+# POPULATION BASED TRAINING options
+parser.add_argument("--population_size",
+                    type=int,
+                    help="number of agents trained in parallel in pbt mode",
+                    default=8)
+parser.add_argument("--pbt_interval",
+                    type=int,
+                    help="number of iterations each member trains between exploit/explore steps",
+                    default=50000)
+parser.add_argument("--pbt_workers",
+                    type=int,
+                    help="number of members trained at the same time",
+                    default=4)
+parser.add_argument("--pbt_member_threads",
+                    type=int,
+                    help="number of cores (and torch threads) given to each member",
+                    default=1)
+parser.add_argument("--pbt_eval_episodes",
+                    type=int,
+                    help="number of episodes used to score each member",
+                    default=10)
+parser.add_argument("--pbt_truncation",
+                    type=float,
+                    help="fraction of worst members replaced by copies of the best ones",
+                    default=0.25)
+
+# CPU PLACEMENT options
+parser.add_argument("--placement",
+                    type=str,
+                    help="auto: pin the environments, learner threads and pool workers to disjoint cores; none: leave to the OS",
+                    default="auto",
+                    choices=["auto", "none"])
+parser.add_argument("--learner_threads",
+                    type=int,
+                    help="learner intra-op worker threads under auto placement (0 for every other physical core of the NUMA node)",
+                    default=0)
+
+# AUTOTUNE options
+parser.add_argument("--autotune_iterations",
+                    type=int,
+                    help="training iterations of each autotune trial",
+                    default=200)
+parser.add_argument("--autotune_max_trials",
+                    type=int,
+                    help="maximum number of autotune trials (a random subset of the search grid)",
+                    default=16)
+parser.add_argument("--autotune_objective",
+                    type=str,
+                    help="throughput maximized by autotune",
+                    default="env_steps_per_second",
+                    choices=["env_steps_per_second", "updates_per_second", "samples_per_second"])
+parser.add_argument("--autotune_output",
+                    type=str,
+                    help="options file the best autotune settings are written to",
+                    default="autotune.json")
 
 # GAME options
 parser.add_argument("--n_actions",
@@ -109,27 +307,152 @@ parser.add_argument("--n_actions",
                     help="number of game output actions",
                     default=2)
 parser.add_argument("--frame_size",
-                    type=str,
+                    type=int,
                     help="size of game frame in pixels",
                     default=84)
+parser.add_argument("--conv_stack",
+                    type=str,
+                    help="conv layers of the networks: standard (paper), small (for low-resolution frames) or auto (small below 64 pixels)",
+                    default="auto",
+                    choices=["auto", "standard", "small"])
+parser.add_argument("--game_init_threads",
+                    type=int,
+                    help="threads constructing games concurrently (experimental, the game is not thread-safe on every platform)",
+                    default=1)
 
 
 
-if __name__ == '__main__': 
-    options = parser.parse_args()
-
-    # Select agent
-    if options.algo == 'dqn':
-        agent = DQNAgent(options)
-    elif options.algo == 'a2c':
-        agent = A2CAgent(options)
-    elif options.algo == 'ppo':
-        agent = PPOAgent(options)
+def make_agent(options):
+    """
+    Create the agent selected by options.algo.
+
+    Arguments:
+        options (argparse.Namespace): run options
+
+    Returns:
+        DQNAgent, A2CAgent or PPOAgent: the agent
+    """
+    if options.n_seeds > 1 and options.mode == 'train':
+        from ensemble import make_ensemble_agent
+        return make_ensemble_agent(options)
+    elif options.algo in AGENTS:
+        return agent_class(options.algo)(options)
     else:
         print("ERROR. This algorithm has not been implemented yet.")
 
+
+def parse_options(args=None):
+    """
+    Parse the command line, using the values of the --config options file
+    (if given) as defaults.
+
+    Arguments:
+        args (list): command line arguments, sys.argv if None
+
+    Returns:
+        argparse.Namespace: run options
+    """
+    options = parser.parse_args(args)
+    if options.config:
+        with open(options.config) as f:
+            config = json.load(f)
+        unknown = sorted(set(config) - set(vars(options)))
+        if unknown:
+            parser.error(f"unknown options in {options.config}: {', '.join(unknown)}")
+        parser.set_defaults(**config)
+        options = parser.parse_args(args)
+    return options
+
+
+def agent_class(algo):
+    """
+    Import the module of an algorithm and return its agent class.
+
+    Arguments:
+        algo (str): algorithm name
+
+    Returns:
+        type: DQNAgent, A2CAgent or PPOAgent
+    """
+    module, name = AGENTS[algo]
+    return getattr(importlib.import_module(module), name)
+
+
+if __name__ == '__main__': 
+    options = parse_options()
+
+    if options.seed is not None:
+        import numpy as np
+        import torch
+        random.seed(options.seed)
+        np.random.seed(options.seed)
+        torch.manual_seed(options.seed)
+
+    # Pin the environments and learner threads before any torch work starts
+    if options.mode in ('train', 'eval'):
+        from placement import place_process
+        place_process(options)
+
+    # Select agent (or the exported policy to evaluate)
+    startup = {'imports': time.perf_counter() - START_TIME}
+    if options.mode == 'eval' and options.inference_model:
+        start = time.perf_counter()
+        from export import load_policy, apply_metadata
+        agent = load_policy(options.inference_model, options.eval_envs)
+        apply_metadata(options, agent.metadata)
+        agent.epsilon = options.final_exploration
+        startup['policy'] = time.perf_counter() - start
+    elif options.mode in ('train', 'eval'):
+        start = time.perf_counter()
+        agent_class(options.algo)
+        startup['agent_import'] = time.perf_counter() - start
+        start = time.perf_counter()
+        agent = make_agent(options)
+        startup['agent_init'] = time.perf_counter() - start
+
+    # Size the replay memory / rollout buffer to fit the memory budget, once
+    # the network, optimizer and games exist
+    if options.memory_budget and options.mode == 'train':
+        from memory_telemetry import fit_to_budget
+        fit_to_budget(agent)
+
+    if options.mode in ('train', 'eval'):
+        startup['total'] = time.perf_counter() - START_TIME
+        print("startup: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in startup.items()))
+        if hasattr(agent, 'metrics'):
+            agent.metrics.add_scalar('perf/startup_seconds', startup['total'], 0)
+
     # Train or evaluate agent
-    if options.mode == 'train':
+    if options.mode == 'sweep':
+        from sweep import sweep_checkpoints
+        sweep_checkpoints(options)
+    elif options.mode == 'export':
+        from export import export_policy
+        export_policy(options)
+    elif options.mode == 'autotune':
+        from autotune import autotune
+        autotune(options)
+    elif options.mode == 'quantize':
+        from quantize import quantize_policy
+        quantize_policy(options)
+    elif options.mode == 'pbt':
+        from pbt import train_population
+        train_population(options)
+    elif options.mode == 'train' and options.profile:
+        from profiling import profile_training
+        profile_training(agent, options)
+    elif options.mode == 'train':
         agent.train()
     elif options.mode == 'eval':
-        agent.play_game()
+        if options.tick_rate:
+            from realtime import play_realtime
+            results = play_realtime(agent, options)
+        elif options.inference_model:
+            from evaluate import evaluate
+            results = evaluate(agent, options)
+        else:
+            results = agent.play_game()
+        print(json.dumps(results, indent=2))
+        if options.eval_output:
+            with open(options.eval_output, 'w') as f:
+                json.dump(results, f, indent=2)
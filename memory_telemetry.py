@@ -0,0 +1,218 @@
+"""
+Memory accounting for long training runs.
+Reports process RSS, the bytes held by replay/rollout buffers and the torch
+allocator statistics to the metrics output, sizes buffers to fit a memory
+budget, and fails fast with a breakdown when the budget is exceeded.
+"""
+
+import os
+import sys
+import resource
+
+import torch
+
+MB = 1024 * 1024
+
+# Python object overhead of one stored experience (namedtuple, floats, list slot)
+EXPERIENCE_OVERHEAD = 256
+
+# Fraction of the budget left free for activations, gradients and fragmentation
+HEADROOM = 0.1
+
+
+
+def process_rss():
+    """
+    Returns:
+        int: resident set size of this process in bytes
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # Peak rather than current RSS, but better than nothing (kB on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def tensor_bytes(tensors):
+    """
+    Count the bytes held by a collection of tensors. Tensors which share a
+    storage (e.g. overlapping stacked frames) are only counted once.
+
+    Arguments:
+        tensors (iterable): tensors, non-tensor items are ignored
+
+    Returns:
+        int: number of bytes
+    """
+    storages = {}
+    for t in tensors:
+        if isinstance(t, torch.Tensor):
+            storage = t.untyped_storage()
+            storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+
+def module_bytes(net, optimizer=None):
+    """
+    Returns:
+        int: bytes held by a network's parameters, gradients and optimizer state
+    """
+    tensors = list(net.parameters()) + [p.grad for p in net.parameters() if p.grad is not None]
+    if optimizer is not None:
+        for state in optimizer.state.values():
+            tensors.extend(state.values())
+    return tensor_bytes(tensors)
+
+
+def allocator_stats():
+    """
+    Returns:
+        dict: torch allocator statistics in bytes (only available on CUDA)
+    """
+    if not torch.cuda.is_available():
+        return {}
+    return {
+        'cuda_allocated': torch.cuda.memory_allocated(),
+        'cuda_reserved': torch.cuda.memory_reserved(),
+        'cuda_max_allocated': torch.cuda.max_memory_allocated()
+    }
+
+
+def state_bytes(options):
+    """
+    Returns:
+        int: bytes of one float32 stacked state
+    """
+    return 4 * options.len_agent_history * int(options.frame_size) ** 2
+
+
+def format_breakdown(breakdown):
+    """
+    Returns:
+        str: human readable memory breakdown, one entry per line
+    """
+    return '\n'.join(f"    {name:<20} {n_bytes / MB:>10.1f} MB" for name, n_bytes in breakdown.items())
+
+
+def warm_up(agent):
+    """
+    Run one forward and backward pass of the agent's network on a dummy
+    batch the size of a learner update, so that the RSS measured afterwards
+    includes the allocator, autograd and thread pool memory of training.
+    The gradients are zeroed again, the weights are left unchanged.
+
+    Arguments:
+        agent (agent): freshly constructed training agent
+    """
+    options = agent.opt
+    if options.algo == 'dqn':
+        # state and next_state of a minibatch per model
+        rows = 2 * options.batch_size * len(replay_memories(agent))
+    else:
+        rows = options.n_workers * options.buffer_update_freq
+    device = next(agent.net.parameters()).device
+    x = torch.zeros(rows, options.len_agent_history, int(options.frame_size), int(options.frame_size), device=device)
+
+    out = agent.net(x)
+    outputs = out if isinstance(out, tuple) else (out,)
+    sum(y.float().sum() for y in outputs).backward()
+    agent.net.zero_grad()
+
+
+def replay_memories(agent):
+    """
+    Returns:
+        list: replay memories of a DQN agent or DQN ensemble
+    """
+    return getattr(agent, 'replay_memories', None) or [agent.replay_memory]
+
+
+def fit_to_budget(agent):
+    """
+    Shrink the replay memory (DQN) or buffer_update_freq (A2C/PPO) of a
+    freshly constructed agent so its buffers fit in options.memory_budget
+    megabytes, on top of what the process uses once the network, optimizer,
+    games and a warm-up update exist. With an ensemble the budget is shared
+    by the buffers of every model. Raises MemoryError if not even the
+    smallest usable buffer fits.
+
+    Arguments:
+        agent (agent): training agent, its options and replay memories are modified in place
+    """
+    options = agent.opt
+    warm_up(agent)
+
+    # Adam allocates its two moment estimates per parameter on the first step
+    optimizer_state = 2 * sum(p.numel() * p.element_size() for p in agent.net.parameters())
+    in_use = process_rss() + optimizer_state
+
+    budget = options.memory_budget * MB
+    available = budget * (1 - HEADROOM) - in_use
+    frame = state_bytes(options) // options.len_agent_history
+
+    if options.algo == 'dqn':
+        # A stored state shares its storage with the previous next_state, so one
+        # transition costs one stacked state plus its new frame
+        memories = replay_memories(agent)
+        per_transition = state_bytes(options) + frame + EXPERIENCE_OVERHEAD
+        capacity = int(available // (per_transition * len(memories)))
+        if capacity < options.batch_size:
+            raise MemoryError(
+                f"memory budget of {options.memory_budget} MB cannot hold {len(memories)} replay memories of even "
+                f"{options.batch_size} transitions ({per_transition / MB:.2f} MB each, "
+                f"{in_use / MB:.1f} MB already in use)"
+            )
+        if capacity < options.replay_memory_size:
+            print(f"Memory budget: reducing replay_memory_size {options.replay_memory_size} -> {capacity}")
+            options.replay_memory_size = capacity
+            for memory in memories:
+                memory.capacity = capacity
+                del memory.memory[:-capacity]
+    else:
+        # Stored rollout states, their stacked copy in optimize_model and activations
+        per_step = 3 * state_bytes(options) * options.n_workers
+        length = int(available // per_step)
+        if length < 1:
+            raise MemoryError(
+                f"memory budget of {options.memory_budget} MB cannot hold a rollout of "
+                f"{options.n_workers} workers ({per_step / MB:.2f} MB per step, "
+                f"{in_use / MB:.1f} MB already in use)"
+            )
+        if length < options.buffer_update_freq:
+            print(f"Memory budget: reducing buffer_update_freq {options.buffer_update_freq} -> {length}")
+            options.buffer_update_freq = length
+
+
+
+class MemoryMonitor():
+
+    def __init__(self, options):
+        """
+        Initialize a memory monitor, which reports memory usage and enforces
+        options.memory_budget (in megabytes, 0 for no budget).
+        """
+        self.budget = options.memory_budget * MB
+
+
+    def check(self, usage, metrics, step):
+        """
+        Report memory usage and raise MemoryError if the process is over budget.
+
+        Arguments:
+            usage (dict): bytes held by each of the agent's buffers
+            metrics (MetricsLogger): metrics output
+            step (int): training step
+        """
+        breakdown = {'rss': process_rss()}
+        breakdown.update(usage)
+        breakdown.update(allocator_stats())
+        for name, n_bytes in breakdown.items():
+            metrics.add_scalar('memory/' + name + '_mb', n_bytes / MB, step)
+
+        if self.budget and breakdown['rss'] > self.budget:
+            raise MemoryError(
+                f"process RSS of {breakdown['rss'] / MB:.1f} MB exceeds the memory budget of "
+                f"{self.budget / MB:.0f} MB at step {step}:\n" + format_breakdown(breakdown)
+            )
@@ -0,0 +1,282 @@
+"""
+Buffered metrics pipeline shared by all agents.
+Scalars are accumulated in preallocated arrays in the training loop and
+flushed to TensorBoard and to a columnar on-disk log from a background
+thread, so logging never blocks an environment step or an optimizer step.
+
+The on-disk log lives in <exp_name>/metrics and consists of one file per
+column (step.i8, value.f8, tag.i4) plus tags.json, which maps the tag
+ids back to names. Use read_metrics() to load it.
+"""
+
+import os
+import json
+import time
+import threading
+import numpy as np
+
+import torch
+
+COLUMNS = (('step', np.int64), ('value', np.float64), ('tag', np.int32))
+
+
+
+class ScalarBuffer():
+
+    def __init__(self, capacity):
+        """
+        Initialize a preallocated buffer of (tag, step, value) records.
+        Values that are still tensors are kept aside and converted to floats
+        when the buffer is flushed, off the training thread.
+        """
+        self.capacity = capacity
+        self.tags = np.empty(capacity, dtype=np.int32)
+        self.steps = np.empty(capacity, dtype=np.int64)
+        self.values = np.empty(capacity, dtype=np.float64)
+        self.tensors = {}
+        self.size = 0
+
+
+    def add(self, tag_id, value, step):
+        """
+        Add a record to the buffer.
+
+        Arguments:
+            tag_id (int): id of the scalar's tag
+            value (float or tensor): scalar value
+            step (int): training step
+
+        Returns:
+            bool: True if the buffer is now full
+        """
+        if isinstance(value, torch.Tensor):
+            self.tensors[self.size] = value.detach()
+            value = np.nan
+        self.tags[self.size] = tag_id
+        self.steps[self.size] = step
+        self.values[self.size] = value
+        self.size += 1
+        return self.size == self.capacity
+
+
+    def resolve(self):
+        """
+        Convert deferred tensor values to floats.
+
+        Returns:
+            tuple: (tags, steps, values) arrays trimmed to the buffer size
+        """
+        for k, tensor in self.tensors.items():
+            self.values[k] = tensor.item()
+        self.tensors = {}
+        return self.tags[:self.size], self.steps[:self.size], self.values[:self.size]
+
+
+    def clear(self):
+        """
+        Empty the buffer without releasing its arrays.
+        """
+        self.tensors = {}
+        self.size = 0
+
+
+
+class MetricsLogger():
+
+    def __init__(self, options, log_dir=None):
+        """
+        Initialize a metrics logger writing to log_dir (defaults to the
+        experiment directory) and start its background flush thread.
+        """
+        self.opt = options
+        self.log_dir = log_dir or self.opt.exp_name
+        self.flush_interval = self.opt.metrics_flush_interval
+
+        # Tag names and their ids in the columnar log
+        self.tag_ids = {}
+
+        # Double buffer: the training thread fills one while the other is flushed
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.buffer = ScalarBuffer(self.opt.metrics_buffer_size)
+        self.spare = ScalarBuffer(self.opt.metrics_buffer_size)
+
+        # Rolling window of completed episode lengths
+        self.episode_lengths = np.zeros(self.opt.metrics_window, dtype=np.float64)
+        self.n_episodes = 0
+
+        # Throughput counters
+        self.n_steps = 0
+        self.last_step = 0
+        self.last_n_steps = 0
+        self.last_n_episodes = 0
+        self.last_time = time.perf_counter()
+
+        # TensorBoard writer, created by the first flush to keep start-up fast
+        self.writer = None
+        self.column_dir = os.path.join(self.log_dir, 'metrics')
+        if not os.path.exists(self.column_dir):
+            os.makedirs(self.column_dir)
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+        self.thread.start()
+
+
+    def tag_id(self, tag):
+        """
+        Look up (or assign) the id of a tag.
+
+        Arguments:
+            tag (str): scalar name
+
+        Returns:
+            int: tag id
+        """
+        tag_id = self.tag_ids.get(tag)
+        if tag_id is None:
+            tag_id = self.tag_ids[tag] = len(self.tag_ids)
+        return tag_id
+
+
+    def add_scalar(self, tag, value, step):
+        """
+        Record a scalar. Tensors are detached here and only converted to
+        Python floats by the flush thread.
+
+        Arguments:
+            tag (str): scalar name
+            value (float or tensor): scalar value, ignored if None
+            step (int): training step
+        """
+        if value is None:
+            return
+        with self.lock:
+            full = self.buffer.add(self.tag_id(tag), value, step)
+            self.last_step = max(self.last_step, step)
+        if full:
+            self.flush()
+
+
+    def add_episode(self, length, step):
+        """
+        Record the length of a finished episode.
+
+        Arguments:
+            length (int): episode length in frames
+            step (int): training step
+        """
+        with self.lock:
+            self.episode_lengths[self.n_episodes % len(self.episode_lengths)] = length
+            self.n_episodes += 1
+        self.add_scalar('episode_length/raw', float(length), step)
+
+
+    def add_steps(self, n_steps):
+        """
+        Count environment steps, used to compute steps per second.
+
+        Arguments:
+            n_steps (int): number of environment steps taken
+        """
+        self.n_steps += n_steps
+
+
+    def _aggregates(self):
+        """
+        Compute rolling aggregates since the last flush.
+
+        Returns:
+            dict: tag -> value
+        """
+        now = time.perf_counter()
+        elapsed = max(now - self.last_time, 1e-9)
+        with self.lock:
+            n_steps, n_episodes = self.n_steps, self.n_episodes
+            window = self.episode_lengths[:min(n_episodes, len(self.episode_lengths))].copy()
+
+        aggregates = {'steps_per_second': (n_steps - self.last_n_steps) / elapsed}
+        if n_episodes > self.last_n_episodes:
+            aggregates['episode_length/mean'] = window.mean()
+            aggregates['episode_length/min'] = window.min()
+            aggregates['episode_length/max'] = window.max()
+        self.last_time, self.last_n_steps, self.last_n_episodes = now, n_steps, n_episodes
+        return aggregates
+
+
+    def flush(self):
+        """
+        Write buffered scalars and rolling aggregates to TensorBoard and to
+        the columnar log.
+        """
+        with self.flush_lock:
+            with self.lock:
+                self.buffer, self.spare = self.spare, self.buffer
+                step = self.last_step
+            tags, steps, values = self.spare.resolve()
+
+            # Append rolling aggregates to the records of this flush
+            aggregates = self._aggregates()
+            with self.lock:
+                agg_ids = np.array([self.tag_id(tag) for tag in aggregates], dtype=np.int32)
+                names = {tag_id: tag for tag, tag_id in self.tag_ids.items()}
+            tags = np.concatenate([tags, agg_ids])
+            steps = np.concatenate([steps, np.full(len(agg_ids), step, dtype=np.int64)])
+            values = np.concatenate([values, np.array(list(aggregates.values()), dtype=np.float64)])
+            self.spare.clear()
+
+            if self.writer is None:
+                from tensorboardX import SummaryWriter
+                self.writer = SummaryWriter(self.log_dir)
+            for tag_id, s, value in zip(tags.tolist(), steps.tolist(), values.tolist()):
+                self.writer.add_scalar(names[tag_id], value, s)
+            self.writer.flush()
+
+            for (name, dtype), column in zip(COLUMNS, (steps, values, tags)):
+                with open(os.path.join(self.column_dir, name + '.' + np.dtype(dtype).str[1:]), 'ab') as f:
+                    column.astype(dtype).tofile(f)
+            with open(os.path.join(self.column_dir, 'tags.json'), 'w') as f:
+                json.dump(names, f)
+
+
+    def _run(self):
+        """
+        Background loop flushing at a fixed cadence.
+        """
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+
+    def close(self):
+        """
+        Stop the flush thread, write out everything that is left and close
+        the TensorBoard writer.
+        """
+        self.stop_event.set()
+        self.thread.join()
+        self.flush()
+        self.writer.close()
+
+
+
+def read_metrics(log_dir):
+    """
+    Load the columnar metrics log of an experiment.
+
+    Arguments:
+        log_dir (str): experiment directory
+
+    Returns:
+        dict: tag -> (steps, values) arrays
+    """
+    column_dir = os.path.join(log_dir, 'metrics')
+    with open(os.path.join(column_dir, 'tags.json')) as f:
+        names = {int(k): v for k, v in json.load(f).items()}
+    columns = {
+        name: np.fromfile(os.path.join(column_dir, name + '.' + np.dtype(dtype).str[1:]), dtype=dtype)
+        for name, dtype in COLUMNS
+    }
+    return {
+        names[tag_id]: (columns['step'][columns['tag'] == tag_id], columns['value'][columns['tag'] == tag_id])
+        for tag_id in np.unique(columns['tag']).tolist()
+    }
@@ -0,0 +1,269 @@
+"""
+Population based training on a single multi-core machine.
+Reference:
+    "Population Based Training of Neural Networks" by Jaderberg et al.
+
+A population of agents with different hyperparameters is trained in a
+process pool, each member pinned to its own cores. Every pbt_interval
+iterations the members are evaluated, the worst members copy the weights
+and optimizer state of the best ones (exploit) and perturb their
+hyperparameters (explore). The population is checkpointed to
+exp_name/population.json after every generation, and a run resumes from
+there if the file exists.
+
+Members write their weights and replay memory under generation-specific
+names (state_<gen>.pt, replay_<gen>), which only become a member's state
+once population.json references them. A run that dies mid-generation
+therefore retrains the whole generation from the last committed state.
+"""
+
+import os
+import glob
+import json
+import random
+import shutil
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+from placement import worker_slots, init_pool_worker
+
+POPULATION_FILE = 'population.json'
+STATE_FILE = 'state_{}.pt'
+REPLAY_DIR = 'replay_{}'
+
+# Hyperparameters searched by each algorithm: name -> (min, max, log scale, integer)
+SEARCH_SPACE = {
+    'dqn': {
+        'learning_rate': (1e-7, 1e-3, True, False),
+        'discount_factor': (0.9, 0.999, False, False),
+        'batch_size': (16, 128, True, True)
+    },
+    'a2c': {
+        'learning_rate': (1e-6, 1e-2, True, False),
+        'entropy_coeff': (1e-4, 1e-1, True, False),
+        'value_loss_coeff': (0.1, 1.0, False, False),
+        'discount_factor': (0.9, 0.999, False, False),
+        'buffer_update_freq': (5, 100, True, True)
+    }
+}
+SEARCH_SPACE['ppo'] = SEARCH_SPACE['a2c']
+
+PERTURB_FACTORS = (0.8, 1.2)
+
+
+
+def sample_hyperparameters(options, rng):
+    """
+    Draw a member's initial hyperparameters from the search space.
+
+    Arguments:
+        options (argparse.Namespace): run options
+        rng (random.Random): random number generator
+
+    Returns:
+        dict: hyperparameter name -> value
+    """
+    hparams = {}
+    for name, (low, high, log, integer) in SEARCH_SPACE[options.algo].items():
+        value = np.exp(rng.uniform(np.log(low), np.log(high))) if log else rng.uniform(low, high)
+        hparams[name] = int(round(value)) if integer else float(value)
+    return hparams
+
+
+def perturb_hyperparameters(options, hparams, rng):
+    """
+    Multiply every hyperparameter by a random perturbation factor, clipped
+    to the search space.
+
+    Arguments:
+        options (argparse.Namespace): run options
+        hparams (dict): hyperparameters to perturb
+        rng (random.Random): random number generator
+
+    Returns:
+        dict: perturbed hyperparameters
+    """
+    perturbed = {}
+    for name, (low, high, log, integer) in SEARCH_SPACE[options.algo].items():
+        value = min(max(hparams[name] * rng.choice(PERTURB_FACTORS), low), high)
+        perturbed[name] = int(round(value)) if integer else float(value)
+    return perturbed
+
+
+def train_member(options, member, generation):
+    """
+    Train one member for pbt_interval iterations from its committed state,
+    save the result as the state of the given generation, then evaluate it.
+    Runs in a pool worker.
+
+    Arguments:
+        options (dict): run options
+        member (dict): population member
+        generation (int): generation being trained
+
+    Returns:
+        dict: evaluation results
+    """
+    from main import make_agent
+
+    options = argparse.Namespace(**options)
+    options.mode = 'train'
+    options.weights_dir = ''
+    options.exp_name = member['dir']
+    options.start_iteration = member['iteration'] + 1
+    options.n_train_iterations = member['iteration'] + options.pbt_interval + 1
+    options.save_frequency = options.n_train_iterations
+    options.save_replay = ''
+    for name, value in member['hparams'].items():
+        setattr(options, name, value)
+
+    # Carry the DQN replay memory over from the previous generation
+    options.load_replay = os.path.join(member['dir'], member['replay']) if member.get('replay') else ''
+
+    agent = make_agent(options)
+    if member.get('state'):
+        state = torch.load(os.path.join(member['dir'], member['state']), map_location=torch.device('cpu'))
+        agent.net.load_state_dict(state['net'])
+        agent.optimizer.load_state_dict(state['optimizer'])
+        for group in agent.optimizer.param_groups:
+            group['lr'] = options.learning_rate
+
+    agent.train()
+
+    state_file = os.path.join(member['dir'], STATE_FILE.format(generation))
+    torch.save({'net': agent.net.state_dict(), 'optimizer': agent.optimizer.state_dict()}, state_file)
+    if options.algo == 'dqn':
+        replay_dir = os.path.join(member['dir'], REPLAY_DIR.format(generation))
+        shutil.rmtree(replay_dir, ignore_errors=True)
+        agent.replay_memory.save(replay_dir)
+
+    options.eval_episodes = options.pbt_eval_episodes
+    options.eval_envs = min(options.eval_envs, options.pbt_eval_episodes)
+    return agent.play_game()
+
+
+def load_population(options):
+    """
+    Load the population checkpoint, or create a new population.
+
+    Arguments:
+        options (argparse.Namespace): run options
+
+    Returns:
+        dict: population state
+    """
+    path = os.path.join(options.exp_name, POPULATION_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            population = json.load(f)
+        print(f"Resuming population from generation {population['generation']}")
+        return population
+
+    rng = random.Random(options.seed)
+    members = []
+    for k in range(options.population_size):
+        member_dir = os.path.join(options.exp_name, f'member_{str(k).zfill(2)}')
+        if not os.path.exists(member_dir):
+            os.makedirs(member_dir)
+        members.append({
+            'id': k,
+            'dir': member_dir,
+            'iteration': 0,
+            'state': None,
+            'replay': None,
+            'hparams': sample_hyperparameters(options, rng),
+            'scores': []
+        })
+    return {'generation': 0, 'rng_state': None, 'members': members}
+
+
+def save_population(options, population):
+    """
+    Atomically write the population checkpoint, then delete the member
+    states it no longer references.
+    """
+    path = os.path.join(options.exp_name, POPULATION_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(population, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+    for member in population['members']:
+        keep = {member['state'], member['replay']}
+        for stale in glob.glob(os.path.join(member['dir'], STATE_FILE.format('*'))):
+            if os.path.basename(stale) not in keep:
+                os.remove(stale)
+        for stale in glob.glob(os.path.join(member['dir'], REPLAY_DIR.format('*'))):
+            if os.path.basename(stale) not in keep:
+                shutil.rmtree(stale, ignore_errors=True)
+
+
+def exploit_and_explore(options, population, rng):
+    """
+    Replace the worst members by perturbed copies of the best ones.
+
+    Arguments:
+        options (argparse.Namespace): run options
+        population (dict): population state, modified in place
+        rng (random.Random): random number generator
+    """
+    ranked = sorted(population['members'], key=lambda m: m['scores'][-1], reverse=True)
+    n_replace = max(1, int(len(ranked) * options.pbt_truncation))
+    if 2 * n_replace > len(ranked):
+        return
+
+    for weak in ranked[-n_replace:]:
+        strong = rng.choice(ranked[:n_replace])
+        shutil.copyfile(os.path.join(strong['dir'], strong['state']), os.path.join(weak['dir'], weak['state']))
+        weak['hparams'] = perturb_hyperparameters(options, strong['hparams'], rng)
+        weak['parent'] = strong['id']
+        print(f"member {weak['id']} ({weak['scores'][-1]:.2f}) <- member {strong['id']} ({strong['scores'][-1]:.2f})")
+
+
+def train_population(options):
+    """
+    Run population based training until every member has trained for
+    options.n_train_iterations iterations.
+
+    Arguments:
+        options (argparse.Namespace): run options
+    """
+    if not os.path.exists(options.exp_name):
+        os.makedirs(options.exp_name)
+    population = load_population(options)
+
+    rng = random.Random(options.seed)
+    if population['rng_state'] is not None:
+        rng.setstate((population['rng_state'][0], tuple(population['rng_state'][1]), population['rng_state'][2]))
+
+    # One pool worker per slot of pbt_member_threads cores
+    context = multiprocessing.get_context('spawn')
+    slots = context.Queue()
+    for cores in worker_slots(options, options.pbt_workers, options.pbt_member_threads):
+        slots.put(cores)
+
+    with ProcessPoolExecutor(options.pbt_workers, mp_context=context,
+                             initializer=init_pool_worker, initargs=(slots, options.pbt_member_threads)) as pool:
+        while min(m['iteration'] for m in population['members']) + 1 < options.n_train_iterations:
+            generation = population['generation'] + 1
+            print(f"Generation {generation}")
+
+            futures = [pool.submit(train_member, vars(options), member, generation) for member in population['members']]
+            for member, future in zip(population['members'], futures):
+                results = future.result()
+                member['iteration'] += options.pbt_interval
+                member['state'] = STATE_FILE.format(generation)
+                member['replay'] = REPLAY_DIR.format(generation) if options.algo == 'dqn' else None
+                member['scores'].append(results['return']['mean'])
+                print(f"member {member['id']}: mean return {results['return']['mean']:.2f} {member['hparams']}")
+
+            exploit_and_explore(options, population, rng)
+            population['generation'] = generation
+            population['rng_state'] = rng.getstate()
+            save_population(options, population)
+
+    best = max(population['members'], key=lambda m: m['scores'][-1])
+    print(f"Best member {best['id']}: mean return {best['scores'][-1]:.2f} {best['hparams']}")
@@ -0,0 +1,296 @@
+"""
+CPU topology-aware placement of the learner, the environments and
+process pool workers.
+Reads the core and NUMA layout from /sys, then:
+- in the training/evaluation process, pins the main thread (which steps
+  the environments and drives the loop) and the torch intra-op worker
+  threads of the learner to disjoint physical cores of one NUMA node, so
+  spinning OpenMP workers do not compete with the environments;
+- in the sweep and PBT process pools, gives every worker its own
+  NUMA-local set of physical cores.
+"""
+
+import os
+import glob
+import threading
+
+import torch
+
+SYSFS_CPU = '/sys/devices/system/cpu'
+SYSFS_NODE = '/sys/devices/system/node'
+
+# Layout chosen by place_process() for this process, None if not placed
+LAYOUT = None
+
+
+
+def parse_cpulist(text):
+    """
+    Parse a kernel cpu list such as "0-3,8,10-11".
+
+    Returns:
+        list: cpu ids
+    """
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def read_int(path, default=0):
+    """
+    Returns:
+        int: integer content of a sysfs file, or default if it is missing
+    """
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return default
+
+
+def allowed_cpus():
+    """
+    Returns:
+        list: ids of the cpus this process may run on, all cpus on
+        platforms without sched_getaffinity
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_topology():
+    """
+    Describe the cpus this process may run on.
+
+    Returns:
+        list: one dict per cpu with its 'cpu' id, NUMA 'node', 'package',
+        'core' id and whether it is the 'primary' hardware thread of its core
+    """
+    allowed = allowed_cpus()
+
+    node_of = {}
+    for path in glob.glob(os.path.join(SYSFS_NODE, 'node[0-9]*', 'cpulist')):
+        node = int(os.path.basename(os.path.dirname(path))[4:])
+        with open(path) as f:
+            for cpu in parse_cpulist(f.read()):
+                node_of[cpu] = node
+
+    topology, seen = [], set()
+    for cpu in allowed:
+        package = read_int(os.path.join(SYSFS_CPU, f'cpu{cpu}', 'topology', 'physical_package_id'))
+        core = read_int(os.path.join(SYSFS_CPU, f'cpu{cpu}', 'topology', 'core_id'), cpu)
+        topology.append({
+            'cpu': cpu,
+            'node': node_of.get(cpu, 0),
+            'package': package,
+            'core': core,
+            'primary': (package, core) not in seen
+        })
+        seen.add((package, core))
+    return topology
+
+
+def ordered_cpus(topology, node=None):
+    """
+    Order cpus so that every physical core comes before any SMT sibling,
+    optionally restricted to one NUMA node first.
+
+    Returns:
+        list: cpu ids
+    """
+    def key(entry):
+        return (node is not None and entry['node'] != node, not entry['primary'], entry['node'], entry['cpu'])
+    return [entry['cpu'] for entry in sorted(topology, key=key)]
+
+
+def plan_process(topology, learner_threads=0):
+    """
+    Choose the cores of a training/evaluation process: one for the main
+    thread and the environments, and disjoint ones for the learner.
+
+    Arguments:
+        topology (list): output of cpu_topology()
+        learner_threads (int): learner worker threads, 0 for every other physical core of the node
+
+    Returns:
+        dict: 'node', 'env' and 'learner' cpu lists
+    """
+    nodes = {}
+    for entry in topology:
+        nodes[entry['node']] = nodes.get(entry['node'], 0) + entry['primary']
+    node = max(sorted(nodes), key=lambda n: nodes[n])
+
+    cpus = ordered_cpus(topology, node)
+    physical = [entry['cpu'] for entry in topology if entry['node'] == node and entry['primary']]
+    n_learner = learner_threads or max(len(physical) - 1, 0)
+    return {'node': node, 'env': cpus[:1], 'learner': cpus[1:1 + n_learner]}
+
+
+def plan_workers(topology, n_workers, threads_per_worker):
+    """
+    Split the cores into disjoint sets for process pool workers, filling
+    NUMA nodes one after the other with physical cores before SMT siblings.
+
+    Arguments:
+        topology (list): output of cpu_topology()
+        n_workers (int): number of sets
+        threads_per_worker (int): cores per set
+
+    Returns:
+        list: one list of cpu ids per worker (empty lists if there are too few cores)
+    """
+    if len(topology) < n_workers * threads_per_worker:
+        return [[] for _ in range(n_workers)]
+
+    # Whole slots from the physical cores of each node, then whatever is left
+    slots, used = [], set()
+    for node in sorted({entry['node'] for entry in topology}):
+        cpus = [entry['cpu'] for entry in topology if entry['node'] == node and entry['primary']]
+        while len(cpus) >= threads_per_worker and len(slots) < n_workers:
+            slots.append(cpus[:threads_per_worker])
+            used.update(cpus[:threads_per_worker])
+            cpus = cpus[threads_per_worker:]
+    rest = [cpu for cpu in ordered_cpus(topology) if cpu not in used]
+    while len(slots) < n_workers:
+        slots.append(rest[:threads_per_worker])
+        rest = rest[threads_per_worker:]
+    return slots
+
+
+def format_cpus(cpus):
+    """
+    Returns:
+        str: compact cpu list, e.g. "0-3,8"
+    """
+    ranges, cpus = [], sorted(cpus)
+    for cpu in cpus:
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else f'{a}-{b}' for a, b in ranges)
+
+
+def set_interop_threads(n_threads):
+    """
+    Set the torch inter-op thread count, which is only possible before any
+    inter-op work has started.
+    """
+    try:
+        torch.set_num_interop_threads(n_threads)
+    except RuntimeError:
+        pass
+
+
+def pin_threads(layout):
+    """
+    Pin the Python threads of this process to the environment core and
+    every other (native) thread, e.g. torch or onnxruntime worker threads,
+    to the learner cores.
+
+    Arguments:
+        layout (dict): output of plan_process()
+    """
+    python_threads = {thread.native_id for thread in threading.enumerate()}
+    for tid in map(int, os.listdir('/proc/self/task')):
+        try:
+            os.sched_setaffinity(tid, layout['env'] if tid in python_threads else layout['learner'])
+        except OSError:
+            continue
+
+
+def pin_inference_thread():
+    """
+    Move the calling thread, and the native threads started since the
+    process was placed (e.g. an onnxruntime thread pool), to the learner
+    cores. Threads inherit the cores of the thread creating them, so an
+    inference thread started from the main thread would otherwise share
+    the environment core with the game loop.
+
+    Returns:
+        list: cpus of the calling thread, empty if nothing was pinned
+    """
+    if LAYOUT is None or not LAYOUT['learner']:
+        return []
+    pin_threads(LAYOUT)
+    os.sched_setaffinity(0, LAYOUT['learner'])
+    return LAYOUT['learner']
+
+
+def place_process(options):
+    """
+    Pin the main thread and the learner threads of this process according
+    to options.placement and log the layout. Threads started afterwards
+    (e.g. the metrics flush thread) inherit the main thread's cores; see
+    pin_inference_thread() for threads which should not.
+
+    Arguments:
+        options (argparse.Namespace): run options
+
+    Returns:
+        dict: chosen layout, None if placement is disabled
+    """
+    if options.placement == 'none' or not hasattr(os, 'sched_setaffinity'):
+        return None
+
+    topology = cpu_topology()
+    layout = plan_process(topology, options.learner_threads)
+    set_interop_threads(1)
+    if not layout['learner']:
+        torch.set_num_threads(1)
+        print(f"placement: 1 cpu available ({format_cpus(layout['env'])}), learner and environments share it")
+        return layout
+
+    # The main thread is the first intra-op thread; start the others so they can be pinned
+    torch.set_num_threads(len(layout['learner']) + 1)
+    torch.nn.functional.conv2d(torch.zeros(16, 4, 84, 84), torch.zeros(32, 4, 8, 8), stride=4)
+
+    pin_threads(layout)
+
+    global LAYOUT
+    LAYOUT = layout
+    print(f"placement: node {layout['node']}, environments/main thread on cpu {format_cpus(layout['env'])}, "
+          f"{len(layout['learner'])} learner threads on cpus {format_cpus(layout['learner'])}")
+    return layout
+
+
+def worker_slots(options, n_workers, threads_per_worker):
+    """
+    Core sets of the workers of a process pool, logged; empty sets (no
+    pinning) if placement is disabled or there are too few cores.
+
+    Returns:
+        list: one list of cpu ids per worker
+    """
+    if options.placement == 'none' or not hasattr(os, 'sched_setaffinity'):
+        return [[] for _ in range(n_workers)]
+
+    slots = plan_workers(cpu_topology(), n_workers, threads_per_worker)
+    if all(slots):
+        print("placement: " + ", ".join(f"worker {k} on cpus {format_cpus(cpus)}" for k, cpus in enumerate(slots)))
+    else:
+        print(f"placement: too few cpus for {n_workers} workers x {threads_per_worker} threads, not pinning")
+    return slots
+
+
+def init_pool_worker(slots, n_threads):
+    """
+    Process pool initializer: claim a core slot and limit torch to it.
+
+    Arguments:
+        slots (multiprocessing.Queue): core sets, one per worker
+        n_threads (int): torch intra-op threads of the worker
+    """
+    cores = slots.get()
+    if cores:
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(n_threads)
+    set_interop_threads(1)
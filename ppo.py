@@ -10,10 +10,14 @@ import random
 import torch
 from torch.distributions.categorical import Categorical
 import numpy as np 
-from tensorboardX import SummaryWriter
 from collections import namedtuple
 
-from game.wrapper import Game
+from metrics import MetricsLogger
+from profiling import PhaseTimer
+from evaluate import evaluate, make_games
+from memory_telemetry import MemoryMonitor, tensor_bytes, module_bytes
+from trajectories import make_recorder, offline_batches
+from conv_stacks import conv_layers, conv_output_size
 
 # Global parameter which tells us if we have detected a CUDA capable device
 CUDA_DEVICE = torch.cuda.is_available()
@@ -31,16 +35,17 @@ class ActorCriticNetwork(torch.nn.Module):
 
         self.opt = options
         
-        self.conv1 = torch.nn.Conv2d(self.opt.len_agent_history, 16, 8, 4)
+        (c1, k1, s1), (c2, k2, s2) = conv_layers(self.opt, 'actor_critic')
+        self.conv1 = torch.nn.Conv2d(self.opt.len_agent_history, c1, k1, s1)
         self.relu1 = torch.nn.ReLU()
-        self.conv2 = torch.nn.Conv2d(16, 32, 4, 2)
+        self.conv2 = torch.nn.Conv2d(c1, c2, k2, s2)
         self.relu2 = torch.nn.ReLU()
-        self.fc3 = torch.nn.Linear(2592, 256) # TODO: Don't hard code
+        self.fc3 = torch.nn.Linear(conv_output_size(self.opt, [self.conv1, self.conv2]), 256)
         self.relu3 = torch.nn.ReLU()
         self.actor = torch.nn.Linear(256, self.opt.n_actions)
         self.critic = torch.nn.Linear(256, 1)
-        self.softmax = torch.nn.Softmax()
-        self.logsoftmax = torch.nn.LogSoftmax()
+        self.softmax = torch.nn.Softmax(dim=-1)
+        self.logsoftmax = torch.nn.LogSoftmax(dim=-1)
 
 
     def init_weights(self, m):
@@ -93,7 +98,6 @@ class ActorCriticNetwork(torch.nn.Module):
 
         # Evaluate action
         action_log_probs = log_probs.gather(1, actions)
-        dist_entropy = -(log_probs * probs).sum(-1).mean()
         return values, actions, action_log_probs
 
     def evaluate_actions(self, x, actions):
@@ -132,18 +136,32 @@ class PPOAgent():
         if CUDA_DEVICE:
             self.net = self.net.cuda()
 
-        # Optimizer
-        self.optimizer = torch.optim.Adam(self.net.parameters(), lr=self.opt.learning_rate)
+        # Optimizer (only needed, and slow to import, when training)
+        self.optimizer = None
+        if self.opt.mode == 'train':
+            self.optimizer = torch.optim.Adam(self.net.parameters(), lr=self.opt.learning_rate)
 
-        # The flappy bird game instance
-        self.games = [Game(self.opt.frame_size) for i in range(self.opt.n_workers)]
+        # The flappy bird game instances (evaluation builds its own games)
+        self.games = []
+        if self.opt.mode == 'train':
+            self.games = make_games(self.opt.frame_size, self.opt.n_workers, self.opt.game_init_threads)
 
         # Log to tensorBoard
-        self.writer = SummaryWriter(self.opt.exp_name)
+        if self.opt.mode == 'train':
+            self.metrics = MetricsLogger(self.opt)
 
         # Buffer
         self.memory = []
 
+        # Per-phase timing of the training loop
+        self.timer = PhaseTimer()
+
+        # Memory usage reporting and budget enforcement
+        self.memory_monitor = MemoryMonitor(self.opt)
+
+        # Trajectory recording for offline training
+        self.recorder = make_recorder(self.opt) if self.opt.mode == 'train' else None
+
 
     def optimize_model(self):
         """
@@ -156,55 +174,105 @@ class PPOAgent():
         Returns:
             loss (float)
         """
-        # Process batch from memory
-        memory = Experience(*zip(*self.memory))
+        with self.timer.phase('collate'):
+            # Process batch from memory
+            memory = Experience(*zip(*self.memory))
+
+            batch = {
+                'state': torch.stack(memory.state).detach(),
+                'action': torch.stack(memory.action).detach(),
+                'reward': torch.tensor(memory.reward).detach(),
+                'mask': torch.stack(memory.mask).detach(),
+                'action_log_prob': torch.stack(memory.action_log_prob).detach(),
+                'value': torch.stack(memory.value).detach()
+            }
+            state_shape = batch['state'].size()[2:]
+            action_shape = batch['action'].size()[-1]
+
+        with self.timer.phase('forward'):
+            # Compute returns
+            returns = torch.zeros(self.opt.buffer_update_freq + 1, self.opt.n_workers, 1)
+            for i in reversed(range(self.opt.buffer_update_freq)):
+                returns[i] = returns[i+1] * self.opt.discount_factor * batch['mask'][i] + batch['reward'][i]
+            returns = returns[:-1]
+            returns = self.normalize_returns(returns)
+
+            # Process batch, in bfloat16 under mixed precision with the losses in float32
+            with self.autocast():
+                values, action_log_probs, dist_entropy = self.net.evaluate_actions(batch['state'].view(-1, *state_shape), batch['action'].view(-1, action_shape)) ### HERE
+            values, action_log_probs, dist_entropy = values.float(), action_log_probs.float(), dist_entropy.float()
+            values = values.view(self.opt.buffer_update_freq, self.opt.n_workers, 1)
+            action_log_probs = action_log_probs.view(self.opt.buffer_update_freq, self.opt.n_workers, 1)
+
+            # Compute advantages
+            advantages = returns - values.detach()
+
+            # Action loss
+            ratio = torch.exp(action_log_probs - batch['action_log_prob'].detach())
+            surr1 = ratio * advantages 
+            surr2 = torch.clamp(ratio, 1-self.opt.grad_clip, 1+self.opt.grad_clip) * advantages
+            action_loss = -self.loss_mean(torch.min(surr1, surr2))
+
+            # Value loss
+            value_loss = self.loss_mean((returns - values).pow(2))
+            value_loss = self.opt.value_loss_coeff * value_loss
+
+            # Total loss
+            loss = value_loss + action_loss - dist_entropy * self.opt.entropy_coeff
 
-        batch = {
-            'state': torch.stack(memory.state).detach(),
-            'action': torch.stack(memory.action).detach(),
-            'reward': torch.tensor(memory.reward).detach(),
-            'mask': torch.stack(memory.mask).detach(),
-            'action_log_prob': torch.stack(memory.action_log_prob).detach(),
-            'value': torch.stack(memory.value).detach()
-        }
-        state_shape = batch['state'].size()[2:]
-        action_shape = batch['action'].size()[-1]
+        # Optimizer step
+        with self.timer.phase('backward'):
+            self.optimizer.zero_grad()
+            # Sum of the per-model losses when training an ensemble
+            loss.sum().backward()
+            self.clip_gradients()
+            self.optimizer.step()
+        self.timer.update()
+
+        return loss, value_loss * self.opt.value_loss_coeff, action_loss, - dist_entropy * self.opt.entropy_coeff
 
-        # Compute returns
-        returns = torch.zeros(self.opt.buffer_update_freq + 1, self.opt.n_workers, 1)
-        for i in reversed(range(self.opt.buffer_update_freq)):
-            returns[i] = returns[i+1] * self.opt.discount_factor * batch['mask'][i] + batch['reward'][i]
-        returns = returns[:-1]
-        returns = (returns - returns.mean()) / (returns.std() + 1e-5)
 
-        # Process batch
-        values, action_log_probs, dist_entropy = self.net.evaluate_actions(batch['state'].view(-1, *state_shape), batch['action'].view(-1, action_shape)) ### HERE
-        values = values.view(self.opt.buffer_update_freq, self.opt.n_workers, 1)
-        action_log_probs = action_log_probs.view(self.opt.buffer_update_freq, self.opt.n_workers, 1)
+    def normalize_returns(self, returns):
+        """
+        Normalize returns to zero mean and unit variance.
 
-        # Compute advantages
-        advantages = returns - values.detach()
+        Arguments:
+            returns (tensor): returns of size (buffer_update_freq, n_workers, 1)
 
-        # Action loss
-        ratio = torch.exp(action_log_probs - batch['action_log_prob'].detach())
-        surr1 = ratio * advantages 
-        surr2 = torch.clamp(ratio, 1-self.opt.grad_clip, 1+self.opt.grad_clip) * advantages
-        action_loss = -torch.min(surr1, surr2).mean()
+        Returns:
+            tensor: normalized returns
+        """
+        return (returns - returns.mean()) / (returns.std() + 1e-5)
 
-        # Value loss
-        value_loss = (returns - values).pow(2).mean()
-        value_loss = self.opt.value_loss_coeff * value_loss
 
-        # Total loss
-        loss = value_loss + action_loss - dist_entropy * self.opt.entropy_coeff
+    def autocast(self):
+        """
+        Returns:
+            context manager: bfloat16 autocast of the forward pass if
+            options.mixed_precision is set, else a no-op
+        """
+        device = 'cuda' if CUDA_DEVICE else 'cpu'
+        return torch.autocast(device, dtype=torch.bfloat16, enabled=bool(self.opt.mixed_precision))
 
-        # Optimizer step
-        self.optimizer.zero_grad()
-        loss.backward()
-        torch.nn.utils.clip_grad_norm(self.net.parameters(), self.opt.max_grad_norm)
-        self.optimizer.step()
 
-        return loss, value_loss * self.opt.value_loss_coeff, action_loss, - dist_entropy * self.opt.entropy_coeff
+    def loss_mean(self, x):
+        """
+        Average a loss term over the rollout.
+
+        Arguments:
+            x (tensor): loss term of size (buffer_update_freq, n_workers, 1)
+
+        Returns:
+            tensor: mean of the term
+        """
+        return x.mean()
+
+
+    def clip_gradients(self):
+        """
+        Clip the gradient norm of the network parameters.
+        """
+        torch.nn.utils.clip_grad_norm(self.net.parameters(), self.opt.max_grad_norm)
 
 
     def env_step(self, states, actions):
@@ -222,10 +290,102 @@ class PPOAgent():
         return torch.stack(next_state_list), reward_list, done_list
 
 
+    def log_episode(self, worker, length, step):
+        """
+        Log the length of a finished episode.
+
+        Arguments:
+            worker (int): index of the worker whose episode ended
+            length (int): episode length in frames
+            step (int): training step
+        """
+        self.metrics.add_episode(length, step)
+
+
+    def log_steps(self, n_steps):
+        """
+        Count environment steps.
+
+        Arguments:
+            n_steps (int): number of environment steps taken
+        """
+        self.metrics.add_steps(n_steps)
+
+
+    def log_losses(self, losses, step):
+        """
+        Log the losses of the latest optimization.
+
+        Arguments:
+            losses (dict): loss name -> value, None before the first optimization
+            step (int): training step
+        """
+        for name, value in losses.items():
+            self.metrics.add_scalar('loss/' + name, value, step)
+
+
+    def save_checkpoint(self, step):
+        """
+        Save the network weights to exp_name/<step>.pt.
+
+        Arguments:
+            step (int): training step
+        """
+        if not os.path.exists(self.opt.exp_name):
+            os.mkdir(self.opt.exp_name)
+        torch.save(self.net.state_dict(), f'{self.opt.exp_name}/{str(step).zfill(7)}.pt')
+
+
+    def memory_usage(self):
+        """
+        Bytes held by the agent's buffers and network.
+
+        Returns:
+            dict: name -> bytes
+        """
+        return {
+            'rollout': tensor_bytes(
+                t for e in self.memory for t in (e.state, e.action, e.action_log_prob, e.value, e.mask)
+            ),
+            'network': module_bytes(self.net, self.optimizer)
+        }
+
+
+    def pretrain(self):
+        """
+        Behaviour cloning: fit the actor to the actions of the recorded
+        trajectories in options.offline_data before training online.
+        """
+        batches = offline_batches(self.opt)
+        for i in range(self.opt.pretrain_iterations):
+            with self.timer.phase('collate'):
+                batch = next(batches)
+                if CUDA_DEVICE:
+                    batch = {key: value.cuda() for key, value in batch.items()}
+
+            with self.timer.phase('forward'):
+                with self.autocast():
+                    _, action_log_probs, _ = self.net.evaluate_actions(batch['state'], batch['action'])
+                loss = -action_log_probs.float().mean()
+
+            with self.timer.phase('backward'):
+                self.optimizer.zero_grad()
+                loss.backward()
+                self.clip_gradients()
+                self.optimizer.step()
+
+            if i % self.opt.log_frequency == 0:
+                self.metrics.add_scalar('loss/behaviour_cloning', loss, i)
+
+
     def train(self):
         """
         Main training loop.
         """
+        # Behaviour cloning from recorded trajectories
+        if self.opt.offline_data:
+            self.pretrain()
+
         # Episode lengths
         episode_lengths = np.zeros(self.opt.n_workers)
 
@@ -233,80 +393,99 @@ class PPOAgent():
         initial_actions = np.zeros(self.opt.n_workers)
         states, _, _ = self.env_step(None, initial_actions)
 
+        # Losses of the latest optimization, logged every log_frequency iterations
+        loss = value_loss = action_loss = entropy_loss = None
+
         # Start a training episode
-        for i in range(1, self.opt.n_train_iterations):
+        for i in range(self.opt.start_iteration, self.opt.n_train_iterations):
 
             # Forward pass through the net
-            values, actions, action_log_probs = self.net.act(states)
+            with self.timer.phase('act'):
+                values, actions, action_log_probs = self.net.act(states)
 
             # Perform action in environment
-            next_states, rewards, dones = self.env_step(states, actions)
-            masks = torch.FloatTensor([[0.0] if done else [1.0] for done in dones])
+            with self.timer.phase('env_step'):
+                next_states, rewards, dones = self.env_step(states, actions)
+                masks = torch.FloatTensor([[0.0] if done else [1.0] for done in dones])
+
+            # Record the transition of every worker
+            if self.recorder is not None:
+                with self.timer.phase('memory'):
+                    for j in range(self.opt.n_workers):
+                        self.recorder.record(j, states[j], actions[j], rewards[j][0], next_states[j][-1:], dones[j])
 
             # Save experience to buffer
-            self.memory.append(
-                Experience(states.data, actions.data, action_log_probs.data, values.data, rewards, masks)
-            )
+            with self.timer.phase('memory'):
+                self.memory.append(
+                    Experience(states.data, actions.data, action_log_probs.data, values.data, rewards, masks)
+                )
+
+            # Report memory usage while the rollout buffer is full
+            if i % self.opt.memory_report_frequency == 0:
+                self.memory_monitor.check(self.memory_usage(), self.metrics, i)
 
             # Perform optimization
-            if i % self.opt.buffer_update_freq == 0:
+            if len(self.memory) == self.opt.buffer_update_freq:
                 loss, value_loss, action_loss, entropy_loss = self.optimize_model()
                 # Reset memory
                 self.memory = []
 
-            # Log episode length
-            for j in range(self.opt.n_workers):
-                if not dones[j]:
-                    episode_lengths[j] += 1
-                else:
-                    self.writer.add_scalar('episode_length/' + str(j), episode_lengths[j], i)
-                    print(j, episode_lengths[j])
-                    episode_lengths[j] = 0
+            with self.timer.phase('logging'):
+                # Log episode length
+                self.log_steps(self.opt.n_workers)
+                for j in range(self.opt.n_workers):
+                    if not dones[j]:
+                        episode_lengths[j] += 1
+                    else:
+                        self.log_episode(j, episode_lengths[j], i)
+                        episode_lengths[j] = 0
 
             # Save network
             if i % self.opt.save_frequency == 0:
-                if not os.path.exists(self.opt.exp_name):
-                    os.mkdir(self.opt.exp_name)
-                torch.save(self.net.state_dict(), f'{self.opt.exp_name}/{str(i).zfill(7)}.pt')
+                with self.timer.phase('checkpoint'):
+                    self.save_checkpoint(i)
 
             # Write results to log
             if i % self.opt.log_frequency == 0:
-                self.writer.add_scalar('loss/total', loss, i)
-                self.writer.add_scalar('loss/action', action_loss, i)
-                self.writer.add_scalar('loss/value', value_loss, i)
-                self.writer.add_scalar('loss/entropy', entropy_loss, i)
+                self.log_losses({'total': loss, 'action': action_loss, 'value': value_loss, 'entropy': entropy_loss}, i)
+                self.timer.report(self.metrics, i)
 
             # Move on to next state
             states = next_states
 
+            self.timer.step()
+
+        if self.recorder is not None:
+            self.recorder.close()
+        self.metrics.close()
+
+
+    def policy(self, states, greedy=True):
+        """
+        Select actions for a batch of states.
+
+        Arguments:
+            states (tensor): minibatch of stacked states
+            greedy (bool): take the most likely action instead of sampling one
+
+        Returns:
+            tensor: action for each state, 0 if no flap, 1 if flap
+        """
+        if CUDA_DEVICE:
+            states = states.cuda()
+        _, action_logits = self.net(states)
+        if greedy:
+            actions = torch.argmax(action_logits, dim=1)
+        else:
+            actions = torch.softmax(action_logits, dim=1).multinomial(1).view(-1)
+        return actions.cpu()
+
 
     def play_game(self):
         """
         Play Flappy Bird using the trained network.
-        """
 
-        # Initialize the environment and state (do nothing)
-        frame, reward, done = self.game.step(0)
-        state = torch.cat([frame for i in range(self.opt.len_agent_history)])
-
-        # Start playing
-        while True:
-
-            # Perform an action
-            state = state.unsqueeze(0)
-            if CUDA_DEVICE:
-                state = state.cuda()
-            _, action, _ = self.net.act(states)
-            if CUDA_DEVICE:
-              action = action.cuda()
-            frame, reward, done = self.game.step(action)
-            if CUDA_DEVICE:
-                frame = frame.cuda()
-            next_state = torch.cat([state[0][1:], frame])
-
-            # Move on to the next state
-            state = next_state
-
-            # If we lost, exit
-            if done:
-                break
\ No newline at end of file
+        Returns:
+            dict: score and episode length statistics
+        """
+        return evaluate(self, self.opt)
@@ -0,0 +1,166 @@
+"""
+Hot-path instrumentation for the training loops.
+PhaseTimer measures the exclusive wall time of each phase of an iteration
+(action selection, environment step, batch collation, forward, backward,
+logging, ...) and reports throughput and per-phase time shares to the
+metrics output. profile_training() runs a short windowed torch.profiler
+and cProfile capture of an agent's training loop.
+"""
+
+import os
+import time
+import cProfile
+import contextlib
+
+import torch
+
+
+
+class PhaseTimer():
+
+    def __init__(self):
+        """
+        Initialize a phase timer. Phases may be nested, in which case the
+        time spent in the inner phase is not counted towards the outer one.
+        """
+        self.totals = {}
+        self.stack = []
+        self.n_iterations = 0
+        self.n_updates = 0
+        self.last_time = time.perf_counter()
+
+        # Set by profile_training() while a torch.profiler capture is running
+        self.profiler = None
+
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the training loop.
+
+        Arguments:
+            name (str): name of the phase
+        """
+        start = time.perf_counter()
+        if self.stack:
+            parent, parent_start = self.stack[-1]
+            self.totals[parent] = self.totals.get(parent, 0.0) + start - parent_start
+        self.stack.append((name, start))
+
+        record = torch.profiler.record_function(name) if self.profiler else contextlib.nullcontext()
+        try:
+            with record:
+                yield
+        finally:
+            end = time.perf_counter()
+            _, resumed = self.stack.pop()
+            self.totals[name] = self.totals.get(name, 0.0) + end - resumed
+            if self.stack:
+                parent, _ = self.stack[-1]
+                self.stack[-1] = (parent, end)
+
+
+    def step(self):
+        """
+        Mark the end of a training iteration.
+        """
+        self.n_iterations += 1
+        if self.profiler:
+            self.profiler.step()
+
+
+    def update(self):
+        """
+        Count an optimizer update.
+        """
+        self.n_updates += 1
+
+
+    def report(self, metrics, step):
+        """
+        Report throughput and per-phase time shares since the last report,
+        then reset the counters.
+
+        Arguments:
+            metrics (MetricsLogger): metrics output
+            step (int): training step
+        """
+        now = time.perf_counter()
+        elapsed = max(now - self.last_time, 1e-9)
+
+        metrics.add_scalar('perf/iterations_per_second', self.n_iterations / elapsed, step)
+        metrics.add_scalar('perf/updates_per_second', self.n_updates / elapsed, step)
+        for name, total in self.totals.items():
+            metrics.add_scalar('perf/time_share/' + name, total / elapsed, step)
+
+        self.totals = {}
+        self.n_iterations = 0
+        self.n_updates = 0
+        self.last_time = now
+
+
+
+def warmup_iterations(options):
+    """
+    Number of warm-up iterations before the profiled window: at least
+    options.profile_warmup, and enough for the window to contain learner
+    updates. DQN does not update until its replay memory holds a batch,
+    A2C/PPO update once every buffer_update_freq iterations.
+
+    Returns:
+        int: number of warm-up iterations
+    """
+    if options.algo == 'dqn':
+        if options.offline_data:
+            return options.profile_warmup
+        return max(options.profile_warmup, options.batch_size)
+    return max(options.profile_warmup, options.buffer_update_freq - options.profile)
+
+
+def profile_training(agent, options):
+    """
+    Run options.profile training iterations of an agent under torch.profiler
+    (CPU ops and memory) and cProfile, after the warm-up iterations (see
+    warmup_iterations), and write the traces to <exp_name>/profile.
+    cProfile covers the warm-up iterations as well.
+
+    Arguments:
+        agent (DQNAgent, A2CAgent or PPOAgent): agent to profile
+        options (argparse.Namespace): run options, n_train_iterations is overwritten
+    """
+    out_dir = os.path.join(options.exp_name, 'profile')
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    # The training loop runs from start_iteration up to (excluding) n_train_iterations
+    warmup = warmup_iterations(options)
+    if warmup > options.profile_warmup:
+        print(f"Profiling: {warmup} warm-up iterations so the profiled window contains learner updates")
+    options.n_train_iterations = options.start_iteration + warmup + options.profile
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    def trace_ready(profiler):
+        profiler.export_chrome_trace(os.path.join(out_dir, 'trace.json'))
+        print(profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=25))
+
+    profiler = torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=0, warmup=warmup, active=options.profile, repeat=1),
+        on_trace_ready=trace_ready,
+        profile_memory=True,
+        record_shapes=True
+    )
+    py_profiler = cProfile.Profile()
+
+    agent.timer.profiler = profiler
+    with profiler:
+        py_profiler.enable()
+        agent.train()
+        py_profiler.disable()
+    agent.timer.profiler = None
+
+    py_profiler.dump_stats(os.path.join(out_dir, 'cprofile.prof'))
+    print(f"Wrote torch.profiler trace and cProfile stats to {out_dir}")
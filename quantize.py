@@ -0,0 +1,158 @@
+"""
+Int8 post-training quantization of trained networks for CPU inference.
+The conv stack of the policy network is statically quantized (fused
+conv+ReLU, activation ranges calibrated on states recorded by playing the
+float policy in Game) and the fully connected layers are dynamically
+quantized. The int8 policy is validated against the float one (action
+agreement on held-out states and greedy episode scores) and saved as
+TorchScript, loadable by eval mode through --inference_model.
+"""
+
+import json
+import random
+import numpy as np
+
+import torch
+import torch.ao.quantization as quantization
+
+from export import load_network, policy_network, policy_metadata, example_input, frame_latency, InferencePolicy, METADATA_FILE
+
+# Action agreement below which the quantized policy is reported as unreliable
+MIN_AGREEMENT = 0.95
+
+THROUGHPUT_BATCH_SIZE = 64
+
+
+
+def record_states(policy, options, n_frames):
+    """
+    Play the float policy in a Game and record the stacked states it visits.
+
+    Arguments:
+        policy (InferencePolicy): float policy
+        options (argparse.Namespace): run options
+        n_frames (int): number of states to record
+
+    Returns:
+        tensor: recorded states of size (n_frames, len_agent_history, frame_size, frame_size)
+    """
+    from game.wrapper import Game
+    from evaluate import initial_state
+
+    game = Game(options.frame_size)
+    state = initial_state(game, options)
+    states = []
+    while len(states) < n_frames:
+        states.append(state)
+        action = int(policy.policy(state.unsqueeze(0), greedy=False)[0])
+        frame, _, _ = game.step(action)
+        state = torch.cat([state[1:], frame])
+    return torch.stack(states)
+
+
+def quantize_network(policy, calibration_states, batch_size=64):
+    """
+    Quantize a forward-only policy network to int8.
+
+    Arguments:
+        policy (torch.nn.Sequential): float network built by export.policy_network
+        calibration_states (tensor): states used to calibrate the activation ranges
+        batch_size (int): calibration batch size
+
+    Returns:
+        torch.nn.Sequential: quantized network (float input, float output)
+    """
+    layers = list(policy)
+    split = next(k for k, layer in enumerate(layers) if isinstance(layer, torch.nn.Flatten))
+
+    # Static quantization of the conv stack, with each conv fused into its ReLU
+    convs = torch.nn.Sequential(quantization.QuantStub(), *layers[:split], quantization.DeQuantStub()).eval()
+    fuse = [[str(k), str(k + 1)] for k, layer in enumerate(convs) if isinstance(layer, torch.nn.Conv2d)]
+    convs = quantization.fuse_modules(convs, fuse)
+    convs.qconfig = quantization.get_default_qconfig(torch.backends.quantized.engine)
+    quantization.prepare(convs, inplace=True)
+    with torch.no_grad():
+        for batch in torch.split(calibration_states, batch_size):
+            convs(batch)
+    quantization.convert(convs, inplace=True)
+
+    # Dynamic quantization of the fully connected layers
+    fcs = quantization.quantize_dynamic(torch.nn.Sequential(*layers[split:]), {torch.nn.Linear}, dtype=torch.qint8)
+    return torch.nn.Sequential(convs, fcs).eval()
+
+
+def compare_policies(reference, candidate, states, options):
+    """
+    Compare a quantized policy against the float one.
+
+    Arguments:
+        reference (InferencePolicy): float policy
+        candidate (InferencePolicy): quantized policy
+        states (tensor): held-out states
+        options (argparse.Namespace): run options
+
+    Returns:
+        dict: action agreement, greedy episode scores, latency and throughput of both policies
+    """
+    from evaluate import evaluate
+
+    greedy = [torch.cat([p.policy(batch) for batch in torch.split(states, THROUGHPUT_BATCH_SIZE)])
+              for p in (reference, candidate)]
+    results = {'action_agreement': float((greedy[0] == greedy[1]).float().mean())}
+
+    x = states[:1]
+    batch = states[:THROUGHPUT_BATCH_SIZE]
+    eval_options = vars(options).copy()
+    eval_options['eval_policy'] = 'greedy'
+    for name, policy in (('float', reference), ('int8', candidate)):
+        # Same game randomness for both policies
+        seed = options.seed or 0
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        episodes = evaluate(policy, type(options)(**eval_options))
+        latency = frame_latency(lambda: policy.scores(x))
+        batch_latency = frame_latency(lambda: policy.scores(batch), n_frames=50)
+        results[name] = {
+            'score': episodes['score'],
+            'episode_length': episodes['episode_length'],
+            'latency_ms': latency,
+            'frames_per_second': len(batch) / batch_latency['mean'] * 1e3
+        }
+    return results
+
+
+def quantize_policy(options):
+    """
+    Quantize options.weights_dir to int8, validate it against the float
+    network and save it as TorchScript to options.export_path.
+
+    Arguments:
+        options (argparse.Namespace): run options
+
+    Returns:
+        dict: validation results
+    """
+    net = load_network(options)
+    policy, kind = policy_network(net)
+    metadata = policy_metadata(options, kind)
+    metadata.update({'format': 'torchscript', 'quantized': True})
+
+    reference = InferencePolicy(policy, metadata)
+    reference.epsilon = options.final_exploration
+    calibration_states = record_states(reference, options, options.calibration_frames)
+    validation_states = record_states(reference, options, max(1, options.calibration_frames // 4))
+    quantized = quantize_network(policy, calibration_states)
+
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(quantized, example_input(options)))
+    torch.jit.save(scripted, options.export_path, _extra_files={METADATA_FILE: json.dumps(metadata)})
+    print(f"Saved int8 {options.algo} policy to {options.export_path}")
+
+    candidate = InferencePolicy(scripted, metadata)
+    results = compare_policies(reference, candidate, validation_states, options)
+    print(json.dumps(results, indent=2))
+    if results['action_agreement'] < MIN_AGREEMENT:
+        print(f"WARNING: int8 policy agrees with the float policy on only "
+              f"{100 * results['action_agreement']:.1f}% of the held-out states")
+    return results
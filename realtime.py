@@ -0,0 +1,213 @@
+"""
+Real-time play with a decoupled inference thread.
+The game advances at a fixed tick rate (options.tick_rate frames per
+second) while the agent picks actions on its own thread from the latest
+frame stack. An action not ready when its frame is due is a deadline
+miss, and the most recent action the agent produced is played instead.
+Reports per-frame inference latency percentiles and histogram, deadline
+misses and the achieved frame rate.
+"""
+
+import time
+import threading
+import numpy as np
+
+import torch
+
+from game.wrapper import Game
+from evaluate import summarize, initial_state
+from placement import pin_inference_thread
+
+# Upper edges of the inference latency histogram bins, in milliseconds
+LATENCY_BINS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+
+class InferenceWorker():
+
+    def __init__(self, agent, greedy):
+        """
+        Start a thread selecting actions for the latest submitted state.
+
+        Arguments:
+            agent (agent or InferencePolicy): anything exposing policy(states, greedy)
+            greedy (bool): take the best action instead of sampling/exploring
+        """
+        self.agent = agent
+        self.greedy = greedy
+        self.condition = threading.Condition()
+
+        # Latest state waiting for an action, and the latest action produced
+        self.pending = None
+        self.action = 0
+        self.action_frame = -1
+
+        self.latencies_ms = []
+        self.error = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name='inference', daemon=True)
+        self.thread.start()
+
+
+    def submit(self, frame_id, state):
+        """
+        Hand the state of a new frame to the inference thread, replacing any
+        older state it has not started on yet.
+        """
+        with self.condition:
+            self.pending = (frame_id, state)
+            self.condition.notify_all()
+
+
+    def wait(self, frame_id, deadline):
+        """
+        Wait until the action for a frame is ready or the deadline passes.
+
+        Arguments:
+            frame_id (int): frame whose action is awaited
+            deadline (float): time.perf_counter() value to give up at
+
+        Returns:
+            bool: True if the action is ready in time
+        """
+        with self.condition:
+            while self.action_frame < frame_id:
+                if self.error is not None:
+                    raise self.error
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+
+    def _run(self):
+        """
+        Inference loop, always working on the newest submitted state.
+        """
+        # Run inference on the learner cores, not the game loop's core
+        pin_inference_thread()
+
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                frame_id, state = self.pending
+                self.pending = None
+
+            try:
+                start = time.perf_counter()
+                with torch.no_grad():
+                    action = int(self.agent.policy(state.unsqueeze(0), self.greedy)[0])
+                latency = (time.perf_counter() - start) * 1e3
+            except Exception as error:
+                with self.condition:
+                    self.error = error
+                    self.condition.notify_all()
+                return
+
+            with self.condition:
+                self.latencies_ms.append(latency)
+                self.action, self.action_frame = action, frame_id
+                self.condition.notify_all()
+
+
+    def stop(self):
+        """
+        Stop the inference thread.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+
+def latency_histogram(latencies_ms):
+    """
+    Returns:
+        dict: bin label -> number of inference calls
+    """
+    edges = (0,) + LATENCY_BINS_MS + (np.inf,)
+    counts, _ = np.histogram(latencies_ms, bins=edges)
+    labels = [f'{lo}-{hi}ms' for lo, hi in zip(edges[:-2], edges[1:-1])] + [f'>{edges[-2]}ms']
+    return dict(zip(labels, counts.tolist()))
+
+
+def play_realtime(agent, options):
+    """
+    Play options.eval_episodes episodes of one game at options.tick_rate
+    frames per second. Episodes reaching options.max_episode_length are
+    cut off and continue in a fresh game.
+
+    Arguments:
+        agent (agent or InferencePolicy): anything exposing policy(states, greedy)
+        options (argparse.Namespace): evaluation options
+
+    Returns:
+        dict: episode statistics, inference latency, deadline misses and achieved frame rate
+    """
+    period = 1.0 / options.tick_rate
+    worker = InferenceWorker(agent, options.eval_policy == 'greedy')
+
+    game = Game(options.frame_size)
+    state = initial_state(game, options)
+    episode_lengths, episode_returns, episode_pipes = [], [], []
+    length, total, pipes = 0, 0.0, 0
+    n_frames, n_misses, n_truncated = 0, 0, 0
+
+    start = time.perf_counter()
+    next_tick = start + period
+    try:
+        while len(episode_lengths) < options.eval_episodes:
+            # Ask for an action on the latest frame stack, due at the next tick
+            worker.submit(n_frames, state)
+            if not worker.wait(n_frames, next_tick):
+                n_misses += 1
+            action = worker.action
+
+            # Advance the game on the tick
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_tick = max(next_tick + period, time.perf_counter())
+
+            frame, reward, done = game.step(action)
+            state = torch.cat([state[1:], frame])
+            n_frames += 1
+            length += 1
+            total += reward
+            pipes += reward >= 1
+
+            truncated = not done and length >= options.max_episode_length
+            if done or truncated:
+                episode_lengths.append(length)
+                episode_returns.append(total)
+                episode_pipes.append(pipes)
+                length, total, pipes = 0, 0.0, 0
+                n_truncated += truncated
+                if truncated:
+                    game = Game(options.frame_size)
+                    state = initial_state(game, options)
+    finally:
+        worker.stop()
+
+    elapsed = time.perf_counter() - start
+    return {
+        'n_episodes': len(episode_lengths),
+        'policy': options.eval_policy,
+        'n_truncated': n_truncated,
+        'score': summarize(episode_pipes),
+        'return': summarize(episode_returns),
+        'episode_length': summarize(episode_lengths),
+        'tick_rate': options.tick_rate,
+        'frames_per_second': n_frames / elapsed,
+        'n_frames': n_frames,
+        'deadline_misses': n_misses,
+        'deadline_miss_rate': n_misses / max(n_frames, 1),
+        'inference_ms': summarize(worker.latencies_ms),
+        'inference_histogram': latency_histogram(worker.latencies_ms),
+        'elapsed_s': elapsed
+    }
@@ -0,0 +1,214 @@
+"""
+Compressed on-disk snapshots of the DQN replay memory.
+Lets a run warm-start from a previously collected buffer instead of paying
+for hours of environment interaction to fill it again.
+
+Layout of a snapshot directory:
+    index.json              format version, generation, frame shape, scale and chunk table
+    chunk_<gen>_00000.npz   compressed uint8 frames + columnar offset/action/reward/done
+    chunk_<gen>_00001.npz   ...
+
+Within a chunk every frame is stored once: transition i has state
+frames[offset[i]:offset[i] + len_agent_history] and next state the same
+window shifted by one frame, so transitions recorded back to back share
+all but one frame.
+
+Every save writes a new generation of chunks and only then atomically
+swaps the index, so a run loading the snapshot while another run re-saves
+it always reads a consistent generation. Generations older than the
+previous one are deleted after the swap.
+"""
+
+import os
+import json
+import numpy as np
+
+import torch
+
+SNAPSHOT_VERSION = 2
+INDEX_FILE = 'index.json'
+
+
+
+def quantize_frames(frames, scale):
+    """
+    Convert float frames to uint8.
+
+    Arguments:
+        frames (tensor): float frames of any shape
+        scale (float): value which maps to 255
+
+    Returns:
+        ndarray: uint8 frames of the same shape
+    """
+    frames = frames.detach().cpu().float() * (255.0 / scale)
+    return frames.round_().clamp_(0, 255).to(torch.uint8).numpy()
+
+
+def dequantize_frames(frames, scale):
+    """
+    Convert uint8 frames back to float tensors.
+
+    Arguments:
+        frames (ndarray): uint8 frames
+        scale (float): value which 255 maps to
+
+    Returns:
+        tensor: float32 frames of the same shape
+    """
+    return torch.from_numpy(frames).float().mul_(scale / 255.0)
+
+
+def frame_scale(states):
+    """
+    Pick the quantization scale for a set of frames: 1 for frames already in
+    [0, 1], otherwise the largest pixel value seen (typically 255).
+
+    Arguments:
+        states (list): list of float frame tensors
+
+    Returns:
+        float: quantization scale
+    """
+    peak = max(float(s.max()) for s in states) if states else 1.0
+    return 1.0 if peak <= 1.0 else peak
+
+
+def pack_chunk(experiences, scale):
+    """
+    Pack consecutive transitions into a frame-once chunk.
+
+    Arguments:
+        experiences (list): transitions of the chunk
+        scale (float): quantization scale
+
+    Returns:
+        dict: uint8 frames and columnar offset/action/reward/done arrays
+    """
+    history = experiences[0].state.size(0)
+    frames, offsets = [], []
+    for e in experiences:
+        if not torch.equal(e.next_state[:-1], e.state[1:]):
+            raise ValueError("next_state is not the state shifted by one frame, cannot snapshot")
+
+        # Continue the frame sequence if this state is the previous next_state
+        state = quantize_frames(e.state, scale)
+        if len(frames) >= history and np.array_equal(state, np.stack(frames[-history:])):
+            offsets.append(len(frames) - history)
+        else:
+            offsets.append(len(frames))
+            frames.extend(state)
+        frames.append(quantize_frames(e.next_state[-1:], scale)[0])
+
+    return {
+        'frames': np.stack(frames),
+        'offset': np.array(offsets, dtype=np.int64),
+        'action': np.array([int(e.action) for e in experiences], dtype=np.int64),
+        'reward': np.array([float(e.reward) for e in experiences], dtype=np.float32),
+        'done': np.array([bool(e.done) for e in experiences], dtype=np.bool_)
+    }
+
+
+def save_replay_snapshot(memory, path, chunk_size=2000):
+    """
+    Write the contents of a replay memory to a snapshot directory as a new
+    generation of chunks.
+
+    Arguments:
+        memory (ReplayMemory): replay memory to serialize
+        path (str): snapshot directory, created if it does not exist
+        chunk_size (int): number of transitions per chunk file
+    """
+    experiences = list(memory.memory)
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    try:
+        previous = read_snapshot_index(path)
+    except (OSError, ValueError, KeyError):
+        previous = None
+    generation = previous['generation'] + 1 if previous else 0
+
+    # Chunks also store the trailing frame of every next_state, which is not
+    # part of any state at the end of an episode
+    scale = frame_scale([e.state for e in experiences] + [e.next_state[-1:] for e in experiences])
+    chunks = []
+    for c, start in enumerate(range(0, len(experiences), chunk_size)):
+        part = experiences[start:start + chunk_size]
+        name = f'chunk_{str(generation).zfill(5)}_{str(c).zfill(5)}.npz'
+        np.savez_compressed(os.path.join(path, name), **pack_chunk(part, scale))
+        chunks.append({'file': name, 'size': len(part)})
+
+    index = {
+        'version': SNAPSHOT_VERSION,
+        'generation': generation,
+        'size': len(experiences),
+        'state_shape': list(experiences[0].state.shape) if experiences else None,
+        'scale': scale,
+        'chunks': chunks
+    }
+
+    # Write the index last (and atomically) so readers never see a partial snapshot
+    tmp_file = os.path.join(path, INDEX_FILE + '.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_file, os.path.join(path, INDEX_FILE))
+
+    # Keep the previous generation for readers still streaming it, drop anything older
+    keep = {chunk['file'] for chunk in chunks}
+    if previous:
+        keep.update(chunk['file'] for chunk in previous['chunks'])
+    for name in os.listdir(path):
+        if name.startswith('chunk_') and name.endswith('.npz') and name not in keep:
+            os.remove(os.path.join(path, name))
+
+
+def read_snapshot_index(path):
+    """
+    Read and validate the index of a snapshot directory.
+
+    Arguments:
+        path (str): snapshot directory
+
+    Returns:
+        dict: snapshot index
+    """
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        index = json.load(f)
+    if index['version'] != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported replay snapshot version {index['version']} in {path}")
+    return index
+
+
+def iter_replay_snapshot(path, skip=0):
+    """
+    Stream transitions out of a snapshot, one chunk in memory at a time.
+
+    Arguments:
+        path (str): snapshot directory
+        skip (int): number of leading (oldest) transitions to skip
+
+    Yields:
+        tuple: (state, action, reward, next_state, done) for each transition
+    """
+    index = read_snapshot_index(path)
+    scale = index['scale']
+
+    for chunk in index['chunks']:
+        if skip >= chunk['size']:
+            skip -= chunk['size']
+            continue
+
+        with np.load(os.path.join(path, chunk['file'])) as data:
+            frames = dequantize_frames(data['frames'], scale)
+            offsets = data['offset'][skip:].tolist()
+            actions = data['action'][skip:].tolist()
+            rewards = data['reward'][skip:].tolist()
+            dones = data['done'][skip:].tolist()
+        skip = 0
+
+        # States are views into the chunk's frames, so transitions recorded
+        # back to back share their frames in memory as well
+        history = index['state_shape'][0]
+        for i, offset in enumerate(offsets):
+            yield frames[offset:offset + history], actions[i], rewards[i], frames[offset + 1:offset + history + 1], dones[i]
@@ -0,0 +1,192 @@
+"""
+Concurrent evaluation of every checkpoint of an experiment.
+Discovers exp_name/<step>.pt, evaluates the checkpoints across a process
+pool and caches the results in exp_name/eval_cache.json, keyed by the
+checkpoint's content hash and the evaluation options, so re-running the
+sweep only evaluates new checkpoints. Writes a ranked table to
+exp_name/sweep_results.csv and eval score curves to exp_name/eval.
+"""
+
+import os
+import csv
+import json
+import glob
+import hashlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from placement import allowed_cpus, worker_slots, init_pool_worker
+
+CACHE_FILE = 'eval_cache.json'
+RESULTS_FILE = 'sweep_results.csv'
+
+# Options which change the outcome of an evaluation
+EVAL_KEYS = (
+    'algo', 'eval_episodes', 'eval_envs', 'eval_policy', 'max_episode_length',
+    'frame_size', 'conv_stack', 'len_agent_history', 'n_actions'
+)
+
+
+
+def find_checkpoints(exp_name):
+    """
+    Find the checkpoints saved by a training run.
+
+    Arguments:
+        exp_name (str): experiment directory
+
+    Returns:
+        list: (step, path) tuples sorted by step
+    """
+    checkpoints = []
+    for path in glob.glob(os.path.join(exp_name, '*.pt')):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        if stem.isdigit():
+            checkpoints.append((int(stem), path))
+    return sorted(checkpoints)
+
+
+def file_hash(path):
+    """
+    Returns:
+        str: sha256 of a file's content
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def config_key(options):
+    """
+    Returns:
+        str: short hash of the options which affect evaluation results
+    """
+    config = {key: str(getattr(options, key)) for key in EVAL_KEYS}
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def load_cache(exp_name):
+    """
+    Returns:
+        dict: cached evaluation results of an experiment
+    """
+    path = os.path.join(exp_name, CACHE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_cache(exp_name, cache):
+    """
+    Atomically write the evaluation cache of an experiment.
+    """
+    path = os.path.join(exp_name, CACHE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def evaluate_checkpoint(options, path):
+    """
+    Evaluate one checkpoint. Runs in a pool worker.
+
+    Arguments:
+        options (dict): run options
+        path (str): checkpoint file
+
+    Returns:
+        dict: evaluation results
+    """
+    from main import make_agent
+
+    options = argparse.Namespace(**options)
+    options.mode = 'eval'
+    options.weights_dir = path
+    return make_agent(options).play_game()
+
+
+def sweep_checkpoints(options):
+    """
+    Evaluate all checkpoints of options.exp_name which are not cached yet,
+    then write the ranked table and TensorBoard curves.
+
+    Arguments:
+        options (argparse.Namespace): run options
+
+    Returns:
+        list: (step, path, results) tuples of every checkpoint, best first
+    """
+    checkpoints = find_checkpoints(options.exp_name)
+    if not checkpoints:
+        print(f"No checkpoints found in {options.exp_name}")
+        return []
+
+    cache = load_cache(options.exp_name)
+    config = config_key(options)
+    keys = {path: file_hash(path) + ':' + config for _, path in checkpoints}
+    todo = [(step, path) for step, path in checkpoints if keys[path] not in cache]
+    print(f"{len(checkpoints)} checkpoints, {len(checkpoints) - len(todo)} cached, evaluating {len(todo)}")
+
+    if todo:
+        n_workers = min(options.sweep_workers, len(todo))
+        n_threads = max(1, len(allowed_cpus()) // n_workers)
+        context = multiprocessing.get_context('spawn')
+        slots = context.Queue()
+        for cores in worker_slots(options, n_workers, n_threads):
+            slots.put(cores)
+
+        with ProcessPoolExecutor(n_workers, mp_context=context,
+                                 initializer=init_pool_worker, initargs=(slots, n_threads)) as pool:
+            futures = {pool.submit(evaluate_checkpoint, vars(options), path): (step, path) for step, path in todo}
+            for future in as_completed(futures):
+                step, path = futures[future]
+                cache[keys[path]] = {'step': step, 'checkpoint': path, 'results': future.result()}
+                save_cache(options.exp_name, cache)
+                print(f"step {step}: mean score {cache[keys[path]]['results']['score']['mean']:.2f}")
+
+    # Rank by mean score, then by mean episode length
+    ranked = sorted(
+        [(step, path, cache[keys[path]]['results']) for step, path in checkpoints],
+        key=lambda r: (r[2]['score']['mean'], r[2]['episode_length']['mean']),
+        reverse=True
+    )
+    write_results(options, ranked)
+    return ranked
+
+
+def write_results(options, ranked):
+    """
+    Print the ranked table, write it as CSV and log the eval curves to TensorBoard.
+
+    Arguments:
+        options (argparse.Namespace): run options
+        ranked (list): (step, path, results) tuples, best first
+    """
+    from tensorboardX import SummaryWriter
+
+    header = ['rank', 'step', 'checkpoint', 'score_mean', 'score_p50', 'score_max', 'length_mean', 'length_p50']
+    rows = [
+        [rank + 1, step, path, results['score']['mean'], results['score']['p50'], results['score']['max'],
+         results['episode_length']['mean'], results['episode_length']['p50']]
+        for rank, (step, path, results) in enumerate(ranked)
+    ]
+
+    with open(os.path.join(options.exp_name, RESULTS_FILE), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+    print(f"{'rank':>4} {'step':>9} {'score':>8} {'p50':>6} {'max':>6} {'length':>9}")
+    for row in rows:
+        print(f"{row[0]:>4} {row[1]:>9} {row[3]:>8.2f} {row[4]:>6.1f} {row[5]:>6.0f} {row[6]:>9.1f}")
+
+    writer = SummaryWriter(os.path.join(options.exp_name, 'eval'))
+    for step, _, results in sorted(ranked, key=lambda r: r[0]):
+        writer.add_scalar('eval/score_mean', results['score']['mean'], step)
+        writer.add_scalar('eval/score_p50', results['score']['p50'], step)
+        writer.add_scalar('eval/episode_length_mean', results['episode_length']['mean'], step)
+    writer.close()
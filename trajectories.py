@@ -0,0 +1,316 @@
+"""
+Recorded game trajectories for offline training.
+TrajectoryRecorder logs the transitions of any training or evaluation run
+into sharded on-disk files; offline_batches streams them back as shuffled,
+prefetched minibatches without loading every shard into RAM.
+
+Layout of a trajectory directory:
+    shard_<run>_<stream>_<k>.npz    one stream (game) of consecutive transitions:
+                                    uint8 frames, action, reward, done and the
+                                    quantization scale of the shard's frames
+
+A shard of n transitions holds n + len_agent_history frames: transition i
+has state frames[i:i + len_agent_history] and next state frames[i + 1:i +
+len_agent_history + 1], so every frame is stored once and shards can be
+read independently of each other.
+"""
+
+import os
+import glob
+import time
+import queue
+import random
+import threading
+import numpy as np
+
+import torch
+
+from replay_snapshot import quantize_frames, dequantize_frames, frame_scale
+
+
+
+def shard_scale(frames):
+    """
+    Quantization scale of a shard: 1 for frames in [0, 1], otherwise at
+    least 255, so a shard of 8-bit images settles on one scale.
+
+    Arguments:
+        frames (list): float frame tensors
+
+    Returns:
+        float: quantization scale
+    """
+    scale = frame_scale(frames)
+    return scale if scale <= 1.0 else max(scale, 255.0)
+
+
+
+class TrajectoryRecorder():
+
+    def __init__(self, directory, shard_size=5000):
+        """
+        Initialize a recorder writing shards of up to shard_size transitions
+        per stream to directory.
+        """
+        self.directory = directory
+        self.shard_size = shard_size
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        # Unique prefix, so several runs can record into the same directory
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.n_shards = 0
+
+        # Stream id -> quantization scale, frames and columns of the shard being filled
+        self.streams = {}
+
+
+    def record(self, stream, state, action, reward, frame, done):
+        """
+        Record one transition of a stream. A state which does not continue
+        the stream's previous transition (e.g. a restarted game) starts a
+        new shard.
+
+        Arguments:
+            stream (int): id of the game the transition comes from
+            state (tensor): stacked state the action was taken in
+            action (int): action taken
+            reward (float): reward received
+            frame (tensor): new frame of the next state, size (1, frame_size, frame_size)
+            done (bool): True if the episode ended
+        """
+        history = state.size(0)
+
+        buffer = self.streams.get(stream)
+        if buffer is not None:
+            self.rescale(buffer, shard_scale([state, frame]))
+            if not np.array_equal(quantize_frames(state, buffer['scale']), np.stack(buffer['frames'][-history:])):
+                self.flush(stream)
+                buffer = None
+        if buffer is None:
+            scale = shard_scale([state, frame])
+            buffer = self.streams[stream] = {
+                'scale': scale, 'frames': list(quantize_frames(state, scale)), 'action': [], 'reward': [], 'done': []
+            }
+
+        buffer['frames'].append(quantize_frames(frame, buffer['scale'])[0])
+        buffer['action'].append(int(action))
+        buffer['reward'].append(float(reward))
+        buffer['done'].append(bool(done))
+        if len(buffer['action']) >= self.shard_size:
+            self.flush(stream, history)
+
+
+    def rescale(self, buffer, scale):
+        """
+        Grow the quantization scale of a stream's buffered frames, so frames
+        brighter than the ones seen so far are not clipped.
+
+        Arguments:
+            buffer (dict): stream buffer
+            scale (float): scale needed by the new frames
+        """
+        if scale <= buffer['scale']:
+            return
+        ratio = buffer['scale'] / scale
+        buffer['frames'] = [np.round(f * ratio).astype(np.uint8) for f in buffer['frames']]
+        buffer['scale'] = scale
+
+
+    def flush(self, stream, history=None):
+        """
+        Write the buffered transitions of a stream to a shard. With history
+        given, the last history frames are kept to continue the stream,
+        otherwise the stream is ended.
+        """
+        buffer = self.streams.get(stream)
+        if buffer is None or not buffer['action']:
+            self.streams.pop(stream, None)
+            return
+
+        path = os.path.join(self.directory, f'shard_{self.run_id}_{stream}_{str(self.n_shards).zfill(5)}.npz')
+        np.savez_compressed(
+            path,
+            frames=np.stack(buffer['frames']),
+            action=np.array(buffer['action'], dtype=np.int64),
+            reward=np.array(buffer['reward'], dtype=np.float32),
+            done=np.array(buffer['done'], dtype=np.bool_),
+            scale=np.array(buffer['scale'], dtype=np.float64)
+        )
+        self.n_shards += 1
+
+        if history is None:
+            del self.streams[stream]
+        else:
+            self.streams[stream] = {
+                'scale': buffer['scale'], 'frames': buffer['frames'][-history:], 'action': [], 'reward': [], 'done': []
+            }
+
+
+    def close(self):
+        """
+        Write out every partially filled shard.
+        """
+        for stream in list(self.streams):
+            self.flush(stream)
+
+
+
+def make_recorder(options):
+    """
+    Returns:
+        TrajectoryRecorder: recorder into options.record_trajectories, None if recording is disabled
+    """
+    if not options.record_trajectories:
+        return None
+    return TrajectoryRecorder(options.record_trajectories, options.trajectory_shard_size)
+
+
+def find_shards(directory):
+    """
+    Returns:
+        list: trajectory shard files of a directory
+    """
+    return sorted(glob.glob(os.path.join(directory, 'shard_*.npz')))
+
+
+def iter_transitions(paths, history, rng):
+    """
+    Stream the transitions of a list of shards, one shard in memory at a
+    time, in random shard order.
+
+    Arguments:
+        paths (list): shard files
+        history (int): number of stacked frames per state
+        rng (random.Random): random number generator
+
+    Yields:
+        tuple: (state frames, next state frames, action, reward, done, scale)
+    """
+    paths = list(paths)
+    rng.shuffle(paths)
+    for path in paths:
+        with np.load(path) as shard:
+            frames, scale = shard['frames'], float(shard['scale'])
+            action, reward, done = shard['action'], shard['reward'], shard['done']
+        for i in range(len(action)):
+            yield frames[i:i + history], frames[i + 1:i + history + 1], action[i], reward[i], done[i], scale
+
+
+def shuffle(items, buffer_size, rng):
+    """
+    Approximately shuffle a stream through a fixed-size buffer.
+
+    Arguments:
+        items (iterable): items to shuffle
+        buffer_size (int): number of items held at once
+        rng (random.Random): random number generator
+
+    Yields:
+        items in shuffled order
+    """
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        k = rng.randrange(buffer_size)
+        yield buffer[k]
+        buffer[k] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def collate(transitions):
+    """
+    Build a minibatch in the format of ReplayMemory.sample.
+
+    Arguments:
+        transitions (list): tuples yielded by iter_transitions
+
+    Returns:
+        dict: state, action, reward, next_state and done tensors
+    """
+    states, next_states, actions, rewards, dones, scales = zip(*transitions)
+    scales = torch.tensor(scales, dtype=torch.float32).view(-1, 1, 1, 1)
+    return {
+        'state': dequantize_frames(np.stack(states), 1.0).mul_(scales),
+        'action': torch.from_numpy(np.array(actions, dtype=np.int64)).unsqueeze(1),
+        'reward': torch.from_numpy(np.array(rewards, dtype=np.float32)),
+        'next_state': dequantize_frames(np.stack(next_states), 1.0).mul_(scales),
+        'done': torch.from_numpy(np.array(dones, dtype=np.bool_))
+    }
+
+
+def stream_batches(directory, history, batch_size, buffer_size, seed=None):
+    """
+    Endless generator of shuffled minibatches, reshuffling the shards on
+    every pass over the data.
+
+    Arguments:
+        directory (str): trajectory directory
+        history (int): number of stacked frames per state
+        batch_size (int): minibatch size
+        buffer_size (int): size of the shuffle buffer in transitions
+        seed (int): random seed
+
+    Yields:
+        dict: minibatch, see collate
+    """
+    paths = find_shards(directory)
+    if not paths:
+        raise FileNotFoundError(f"No trajectory shards found in {directory}")
+
+    rng = random.Random(seed)
+    batch = []
+    while True:
+        for transition in shuffle(iter_transitions(paths, history, rng), buffer_size, rng):
+            batch.append(transition)
+            if len(batch) == batch_size:
+                yield collate(batch)
+                batch = []
+
+
+def prefetch(generator, n_items):
+    """
+    Run a generator in a background thread, n_items ahead of the consumer.
+
+    Arguments:
+        generator (iterator): items to produce
+        n_items (int): size of the prefetch queue
+
+    Yields:
+        the items of generator
+    """
+    items = queue.Queue(maxsize=n_items)
+    done = object()
+
+    def produce():
+        try:
+            for item in generator:
+                items.put(item)
+        except Exception as error:
+            items.put(error)
+        items.put(done)
+
+    threading.Thread(target=produce, name='trajectory-prefetch', daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def offline_batches(options):
+    """
+    Returns:
+        iterator: endless prefetched minibatches of options.batch_size
+        transitions from options.offline_data
+    """
+    batches = stream_batches(
+        options.offline_data, options.len_agent_history, options.batch_size,
+        options.offline_shuffle_buffer, options.seed
+    )
+    return prefetch(batches, options.offline_prefetch)